@@ -6,8 +6,20 @@ opx_bld_basics.py set of classes and defines intrinsic to the basic
 
 from __future__ import print_function
 import os
+import errno
 import fnmatch
+import gzip
+import logging
+import re
 import subprocess
+from distutils.spawn import find_executable
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# log level below DEBUG, for per-directory detail of file tree walks
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
 
 
 class ChangeDirectory(object):
@@ -19,22 +31,29 @@ class ChangeDirectory(object):
         return to the original working directory
     """
     def __init__(self, path):
-        self.old_dir = os.getcwd()
+        self._old_fd = None
         self.new_dir = path
 
     def __enter__(self):
-        os.chdir(self.new_dir)
+        # hold the current directory open, so it can be restored even
+        #  if it is renamed while we are elsewhere
+        self._old_fd = os.open('.', os.O_RDONLY
+                                    | getattr(os, 'O_DIRECTORY', 0))
+        try:
+            os.chdir(self.new_dir)
+        except OSError:
+            os.close(self._old_fd)
+            self._old_fd = None
+            raise
 
     def __exit__(self, exc_type, exc_value, exc_tb):
-        os.chdir(self.old_dir)
-
-        # Return correct value for python to raise
-        #  an exception embedded in the context
-        #  basically works now because default
-        #  return for a function is None which
-        #  evaluates to False
-        if exc_type is None:
-            return True
+        try:
+            os.fchdir(self._old_fd)
+        finally:
+            os.close(self._old_fd)
+            self._old_fd = None
+
+        # Never suppress an exception raised within the context
         return False
 
 
@@ -50,7 +69,7 @@ ONIE_PLATFORM_MAP = {
 }
 
 # need to harmonize with the above list
-PLATFORMS = ONIE_PLATFORM_MAP.keys()
+PLATFORMS = tuple(ONIE_PLATFORM_MAP)
 IMAGES = ['ALL-Base']
 ARCHS = ['x86_64']
 
@@ -71,6 +90,7 @@ RELEASE_DIRS = [DEV_RELEASE, 'testing']
 #       state (only one at at time), all others
 #       will be stable + nmae
 INACTIVE_STATES = ['deprecated', 'retired']
+_INACTIVE = frozenset(INACTIVE_STATES)
 RELEASE_STATES = ['sid', 'unstable', 'testing', 'stable'] + INACTIVE_STATES
 
 RELEASES = [
@@ -81,10 +101,21 @@ RELEASES = [
       }
 ]
 
-RELEASES_BY_NAME = {_r['rel-name']: _r for _r in RELEASES}
-RELEASES_BY_VERSION = {_r['rel-version']: _r for _r in RELEASES}
-
-RELEASE_NAMES = [n_['rel-name'] for n_ in RELEASES] + RELEASE_DIRS
+# lookup tables derived from RELEASES, built in a single pass
+RELEASES_BY_NAME = {}
+RELEASES_BY_VERSION = {}
+RELEASE_NAMES = []
+_active = []
+for _r in RELEASES:
+    RELEASES_BY_NAME[_r['rel-name']] = _r
+    RELEASES_BY_VERSION[_r['rel-version']] = _r
+    RELEASE_NAMES.append(_r['rel-name'])
+    if _r['rel-state'] not in _INACTIVE:
+        _active.append(_r['rel-name'])
+RELEASE_NAMES += RELEASE_DIRS
+_RELEASE_NAMES_SET = frozenset(RELEASE_NAMES)
+_ACTIVE_NAMES = tuple(_active + RELEASE_DIRS)
+del _r, _active
 
 
 INST_GOOD_LINK = 'last_good'
@@ -95,6 +126,13 @@ DEFAULT_DIRNAME = 'latest-build'
 
 VERBOSITY = 0
 
+# parallel gzip, used in place of the gzip module when installed
+PIGZ = find_executable('pigz')
+
+
+# release_path results, keyed by (publication, release)
+_RELEASE_PATH_CACHE = {}
+
 
 def release_path(publication=DEFAULT_PUB, release=DEFAULT_RELEASE):
     """
@@ -104,54 +142,130 @@ def release_path(publication=DEFAULT_PUB, release=DEFAULT_RELEASE):
                         tftboot or archive (netarchive)
         release - which release build installers
     """
-    assert release in RELEASE_NAMES
+    try:
+        path = _RELEASE_PATH_CACHE[(publication, release)]
+    except KeyError:
+        assert release in _RELEASE_NAMES_SET
 
-    path = PUB_LOCS[publication]
+        path = PUB_LOCS[publication]
 
-    if path is not None:
-        if release in RELEASE_DIRS:
-            rel_dir = '%s-release'
-        else:
-            rel_dir = 'release_%s-release'
+        if path is not None:
+            if release in RELEASE_DIRS:
+                rel_dir = '%s-release'
+            else:
+                rel_dir = 'release_%s-release'
+
+            path = os.path.join(path, (rel_dir % release),
+                                'AmazonInstallers')
 
-        path = os.path.join(path, (rel_dir % release),
-                            'AmazonInstallers')
+        _RELEASE_PATH_CACHE[(publication, release)] = path
 
-    if release is not DEFAULT_RELEASE and VERBOSITY > 0:
+    if release != DEFAULT_RELEASE and VERBOSITY > 0:
         print('release path returns %s' % path)
     return path
 
 
+# shell patterns reducible to plain string tests: '*<suffix>' and
+#  '*<substring>*', where the literal part has no wildcards
+_SUFFIX_PATTERN = re.compile(r'\A\*([^*?[]+)\Z')
+_SUBSTR_PATTERN = re.compile(r'\A\*([^*?[]+)\*\Z')
+
+# file name match functions, keyed by shell pattern string
+_PATTERN_CACHE = {}
+
+
+def _pattern_matcher(pattern):
+    """
+    _pattern_matcher -- return a function testing whether a file name
+                        matches a shell pattern, building it only on
+                        first use
+    """
+    try:
+        return _PATTERN_CACHE[pattern]
+    except KeyError:
+        pass
+
+    # the common patterns need no regular expression at all
+    match = _SUFFIX_PATTERN.match(pattern)
+    if match:
+        matcher = lambda name, _sfx=match.group(1): name.endswith(_sfx)
+    else:
+        match = _SUBSTR_PATTERN.match(pattern)
+        if match:
+            matcher = lambda name, _sub=match.group(1): _sub in name
+        else:
+            matcher = re.compile(fnmatch.translate(pattern)).match
+
+    _PATTERN_CACHE[pattern] = matcher
+    return matcher
+
+
 def find_files(path='workspace/debian/jessie/x86_64/build', find='*.deb',
-               out_filter='*-dev_*'):
+               out_filter='*-dev_*', exclude_dirs=('.git', '.pc', 'tmp'),
+               followlinks=False):
     """
-    find_files - find the files that match criteria and return the list
+    find_files - find the files that match criteria and yield them
     input:
         path - where to start file tree walk
         find - regular expression of desired file name(s)
         out_filter - regular expression of file names to exclude
-    return: list of file paths
+        exclude_dirs - names of directories not to descend into, or
+                       a callable taking a directory name and returning
+                       True if it should be skipped
+        followlinks - descend into symbolic links to directories,
+                      each real directory is visited only once
+    return: generator of file paths
     """
-    flist = []
-
-    for rdir, srdirs, files in os.walk(path):
-        if VERBOSITY > 1:
-            print("searching " + rdir)
-            if VERBOSITY > 2:
-                for _sd in srdirs:
-                    print("  has subdir " + _sd)
-
+    # resolve the shell patterns once, rather than per file name,
+    #  and bind the match functions to locals for the inner loop
+    find_match = _pattern_matcher(find)
+    if out_filter is not None:
+        out_match = _pattern_matcher(out_filter)
+    else:
+        out_match = None
+
+    if exclude_dirs is None:
+        skip_dir = None
+    elif callable(exclude_dirs):
+        skip_dir = exclude_dirs
+    else:
+        skip_dir = frozenset(exclude_dirs).__contains__
+
+    # real paths of the directories visited, to break symlink cycles
+    seen = set([os.path.realpath(path)]) if followlinks else None
+
+    for rdir, srdirs, files in os.walk(path, followlinks=followlinks):
+        # prune in place, so os.walk never visits the excluded subtrees
+        if skip_dir is not None:
+            srdirs[:] = [_sd for _sd in srdirs if not skip_dir(_sd)]
+
+        if seen is not None:
+            _keep = []
+            for _sd in srdirs:
+                _real = os.path.realpath(os.path.join(rdir, _sd))
+                if _real not in seen:
+                    seen.add(_real)
+                    _keep.append(_sd)
+            srdirs[:] = _keep
+
+        logger.debug("searching %s", rdir)
+        logger.log(TRACE, "  has subdirs %s", srdirs)
+
+        # join once per directory; adds a separator only if needed
+        prefix = os.path.join(rdir, '')
         for fname in files:
-            if fnmatch.fnmatch(fname, find):
-                if out_filter is not None \
-                        and fnmatch.fnmatch(fname, out_filter):
+            if find_match(fname):
+                if out_match is not None and out_match(fname):
                     continue
-                flist.append(os.path.join(rdir, fname))
-                # consider making this an itterator/factory>
-                #  return/pause until end -- can't recall what
-                #  the patern name is right now
+                yield prefix + fname
+
 
-    return flist
+def find_files_list(*args, **kwargs):
+    """
+    find_files_list - as find_files, but return the matches as a list
+                      for callers that need the whole result at once
+    """
+    return list(find_files(*args, **kwargs))
 
 
 def short_path(file_path):
@@ -163,12 +277,13 @@ def short_path(file_path):
     returns: string <directory name><os path seperator><file name>
     diagnostic: raises exception if file not found
     """
-    if not os.path.exists(file_path):
+    # abspath is string manipulation only, so this is the one stat
+    full_path = os.path.abspath(file_path)
+    if not os.path.lexists(full_path):
         raise NameError(('%s does not exist' % file_path))
 
-    full_path = os.path.abspath(file_path)
     my_dir = os.path.basename(os.path.dirname(full_path))
-    return os.path.join(my_dir, os.path.sep, os.path.basename(full_path))
+    return os.path.join(my_dir, os.path.basename(full_path))
 
 
 def gen_package_list(pkg_cache_path):
@@ -178,33 +293,53 @@ def gen_package_list(pkg_cache_path):
     input:
         pkg_cache_path - Path to the folder containing the package cache
     returns: None
-    diagnostic: raises exception if call to dpkg-scanpackages or gzip fails
+    diagnostic: raises exception if call to dpkg-scanpackages or pigz fails
     """
     packages_file = os.path.join(pkg_cache_path, 'Packages')
     packages_gz_file = os.path.join(pkg_cache_path, 'Packages.gz')
 
-    # Create a package repository in the cache
-    # Do the write first so the file exists,
-    # or try read/write fails not found
+    # Create a package repository in the cache, writing Packages and
+    #  the gzipped version used by apt-get from the one scan, rather
+    #  than re-reading Packages through a separate gzip process
     cmd = ['dpkg-scanpackages', '-m', '.', '/dev/null']
-    with open(packages_file, 'w+') as fd_:
-        try:
-            subprocess.check_call(cmd, stdout=fd_,
-                                  cwd=pkg_cache_path)
-        except subprocess.CalledProcessError as ex:
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            cwd=pkg_cache_path)
+    zproc = zcmd = None
+    try:
+        with open(packages_file, 'wb') as fd_, \
+                open(packages_gz_file, 'wb') as fd0:
+            # pigz produces the same gzip stream using all cores
+            if PIGZ is not None:
+                zcmd = [PIGZ, '-9c']
+                zproc = subprocess.Popen(zcmd, stdin=subprocess.PIPE,
+                                         stdout=fd0, cwd=pkg_cache_path)
+                zfd = zproc.stdin
+            else:
+                zfd = gzip.GzipFile(fileobj=fd0, mode='wb',
+                                    compresslevel=9)
+
+            try:
+                for chunk in iter(lambda: proc.stdout.read(65536), b''):
+                    fd_.write(chunk)
+                    zfd.write(chunk)
+                zfd.close()
+            except IOError as ex:
+                # pigz exited early, its status is reported below
+                if zproc is None or ex.errno != errno.EPIPE:
+                    raise
+    finally:
+        # reap both children whether or not the copy completed
+        proc.stdout.close()
+        proc.wait()
+        if zproc is not None:
+            zproc.stdin.close()
+            zproc.wait()
+
+    for child, child_cmd in ((zproc, zcmd), (proc, cmd)):
+        if child is not None and child.returncode != 0:
+            ex = subprocess.CalledProcessError(child.returncode, child_cmd)
             print(ex)
-            raise
-
-    # Add a gzipped version of Packages for use by apt-get
-    cmd = ['gzip', '-9c']
-    with open(packages_file, 'r') as fd_, \
-            open(packages_gz_file, 'w') as fd0:
-        try:
-            subprocess.check_call(cmd, stdin=fd_, stdout=fd0,
-                                  cwd=pkg_cache_path)
-        except subprocess.CalledProcessError as ex:
-            print(ex)
-            raise
+            raise ex
 
 
 # set of support functions for RELEASES above
@@ -225,15 +360,20 @@ def valid_rel_name(name):
     return name in RELEASES_BY_NAME
 
 
+def validate_release_names(names):
+    """
+    validate_release_names -- return the subset of the names passed in
+                              that are valid release names
+    """
+    return frozenset(names) & _RELEASE_NAMES_SET
+
+
 # active release names
 def active_release_names():
     """
     Fetch all the active names
     """
-    names = [n_['rel-name'] for n_ in RELEASES
-                                if n_['rel-state'] is not 'retired']
-    names = names + RELEASE_DIRS
-    return names
+    return list(_ACTIVE_NAMES)
 
 
 # name query
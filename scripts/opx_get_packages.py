@@ -8,14 +8,18 @@ from __future__ import print_function
 import apt
 import apt_pkg
 import collections
+import functools
+import hashlib
+import json
 import sys
 import os
 import shutil
 import subprocess
+import time
 import argparse
 import logging
-import itertools
-from distutils.version import LooseVersion
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
@@ -29,6 +33,20 @@ DEFAULT_PKG_URL = "http://deb.openswitch.net/"
 DEFAULT_PKG_DISTRIBUTION = "unstable"
 DEFAULT_PKG_COMPONENT = "main opx opx-non-free"
 
+DEFAULT_PARALLEL_JOBS = min(8, multiprocessing.cpu_count())
+
+# seconds for which up to date package lists are reused
+DEFAULT_CACHE_TTL = 3600
+
+
+# "or" dependency alternatives dropped so that the remaining one can
+# be resolved (see :meth:`OpxPackages._dependency_candidates`)
+SPECIAL_OR = frozenset(('makedev', 'debconf-2.0'))
+
+# sort key ordering :class:`VersionWrapper` objects by Debian version
+_debian_version_key = functools.cmp_to_key(
+    lambda a, b: apt_pkg.version_compare(a.ver_str, b.ver_str))
+
 
 class VersionWrapper(object):
     """
@@ -39,15 +57,21 @@ class VersionWrapper(object):
     make the objects hashable.
     """
 
+    __slots__ = ('_ver', '_key', '_hash')
+
     def __init__(self, version):
         self._ver = version
+        self._key = (version.parent_pkg.name, version.ver_str)
+        self._hash = hash(self._key)
 
     def __hash__(self):
-        return hash((self._ver.parent_pkg.name, self._ver.ver_str))
+        return self._hash
 
     def __eq__(self, other):
-        return (self._ver.parent_pkg.name == other._ver.parent_pkg.name and
-                self._ver.ver_str == other._ver.ver_str)
+        return self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
 
     def __str__(self):
         return self._ver.__str__()
@@ -117,7 +141,9 @@ class OpxPackages(object):
                  default_solver=False,
                  sysrootdev=None,
                  install_recommends=False,
-                 install_suggests=False):
+                 install_suggests=False,
+                 cache_ttl=DEFAULT_CACHE_TTL,
+                 memonly=False):
         """
         Construct a :class:`OpxPackages` object
 
@@ -132,9 +158,22 @@ class OpxPackages(object):
            If ``True``, install recommended packages.
         :param install_suggests:
            If ``True``, install suggested packages.
+        :param cache_ttl:
+           Seconds for which package lists fetched from the same
+           sources are reused without updating; 0 always updates.
+        :param memonly:
+           If ``True``, build the package cache in memory only rather
+           than keeping pkgcache.bin in the sysroot between runs.
         """
         self._apt_cache = None
         self._cache = None
+        # (package id, version string) pairs already resolved
+        self._fetched = set()
+        # package name -> (:class:`apt.Package`, list of its versions)
+        self._pkg_lookup = {}
+        # (target package id, target version, comparison type) ->
+        # list of :class:`apt_pkg.Version` satisfying the dependency
+        self._all_targets_cache = {}
         self._default_solver = default_solver
         self._pkg_sources = pkg_sources
         self._folder = sysroot
@@ -177,56 +216,216 @@ class OpxPackages(object):
             if not os.path.exists(self._apt_cache) \
                             and os.path.exists(_build_cache):
                 print("Copying.. " + _build_cache)
-                shutil.copytree(_build_cache, self._apt_cache, symlinks=True)
+                self._copy_tree(_build_cache, self._apt_cache)
 
         self._apt_cache = os.path.join(self._folder, "var", "cache",
                                                         "apt", "archives")
         self.sources = os.path.join(self._folder, "etc", "apt", "sources.list")
-        if not os.path.exists(self.sources):
-            if not os.path.exists(os.path.dirname(self.sources)):
-                os.makedirs(os.path.dirname(self.sources))
-        else:
-            shutil.copy(self.sources, self.sources + ".save")
+        if not os.path.exists(os.path.dirname(self.sources)):
+            os.makedirs(os.path.dirname(self.sources))
 
         # create sources.list file with url, distribution, and component.
-        with open(self.sources, "w") as f:
-            for pkg_source in self._pkg_sources:
-                source = "{} {} {}".format(
-                    pkg_source.url,
-                    pkg_source.distribution,
-                    pkg_source.component,
-                )
-
-                # local packages must be explicitly trusted
-                if "copy:/mnt" in pkg_source.url:
-                    options = "[arch=amd64 trusted=yes]"
-                else:
-                    options = "[arch=amd64]"
+        sources_list = ""
+        for pkg_source in self._pkg_sources:
+            source = "{} {} {}".format(
+                pkg_source.url,
+                pkg_source.distribution,
+                pkg_source.component,
+            )
+
+            # local packages must be explicitly trusted
+            if "copy:/mnt" in pkg_source.url:
+                options = "[arch=amd64 trusted=yes]"
+            else:
+                options = "[arch=amd64]"
 
-                print("Using {}".format(source))
+            print("Using {}".format(source))
 
-                f.write("deb %s %s\n" % (options, source))
+            sources_list += "deb %s %s\n" % (options, source)
+
+        # apt rebuilds pkgcache.bin when sources.list is newer, so only
+        #  write it (saving the previous one) when the sources change
+        if self._read_file(self.sources) != sources_list:
+            if os.path.exists(self.sources):
+                shutil.copy(self.sources, self.sources + ".save")
+            with open(self.sources, "w") as f:
+                f.write(sources_list)
 
         # create apt preferences file to always use local packages
-        with open(os.path.join(self._folder, "etc", "apt", "preferences"), "w") as f:
-            f.write('Package: *\nPin: origin ""\nPin-Priority: 1100\n\n')
-            f.write('Package: *\nPin: origin "deb.openswitch.net"\nPin-Priority: 750\n\n')
+        preferences = os.path.join(self._folder, "etc", "apt", "preferences")
+        preferences_list = (
+            'Package: *\nPin: origin ""\nPin-Priority: 1100\n\n'
+            'Package: *\nPin: origin "deb.openswitch.net"\nPin-Priority: 750\n\n'
+        )
+        if self._read_file(preferences) != preferences_list:
+            with open(preferences, "w") as f:
+                f.write(preferences_list)
+
+        # set Install-Recommends and Install-Suggests configuration
+        #  options before the cache (and its dependency cache) is built
+        for key, value in (('APT::Install-Recommends', install_recommends),
+                           ('APT::Install-Suggests', install_suggests)):
+            if apt_pkg.config.find_b(key) != bool(value):
+                apt_pkg.config[key] = "1" if value else "0"
+
+        # create cache and update it; unless memonly, the cache is file
+        #  backed so the parsed package lists are kept between runs.
+        #  apt.Cache clears these settings for a memonly cache, so
+        #  restore them in case one was created earlier.
+        if not memonly:
+            apt_pkg.config['Dir::Cache::pkgcache'] = 'pkgcache.bin'
+            apt_pkg.config['Dir::Cache::srcpkgcache'] = 'srcpkgcache.bin'
+        self._cache = apt.Cache(rootdir=self._folder, memonly=memonly)
+
+        # The stamp file records the sources the package lists were
+        #  last updated from, and its mtime when that happened
+        self._lists_stamp = os.path.join(self._folder, "var", "lib", "apt",
+                                         "lists", "opx-sources.list")
+
+        if self._lists_current(sources_list, cache_ttl):
+            print("Package lists are up to date, skipping update")
+        else:
+            try:
+                self._cache.update()
+            except Exception as ex:
+                print("\nCache update error ignored : %s\n" % (ex))
+            else:
+                with open(self._lists_stamp, "w") as f:
+                    f.write(sources_list)
 
-        # create cache and update it
-        self._cache = apt.Cache(rootdir=self._folder, memonly=True)
+        self._cache.open()
 
-        # set Install-Recommends and Install-Suggests configuration options
-        apt_pkg.config['APT::Install-Recommends'] = \
-            "1" if install_recommends else "0"
-        apt_pkg.config['APT::Install-Suggests'] = \
-            "1" if install_suggests else "0"
+        # The lock file records the packages installed, upgraded or
+        #  downgraded by the last fetch, keyed by everything the
+        #  resolution depends on
+        self._lock_file = os.path.join(self._folder, "var", "cache", "apt",
+                                       "opx-lock.json")
+        self._inputs_hash = self._hash_inputs(
+            sources_list,
+            (default_solver, install_recommends, install_suggests))
 
+    def _hash_inputs(self, sources_list, options):
+        """
+        Return a digest of the inputs to dependency resolution: the
+        package sources and solver options, and the contents of the
+        package lists and dpkg status file
+        """
+        digest = hashlib.sha256()
+        digest.update(sources_list)
+        digest.update(repr(options))
+
+        lists = os.path.join(self._folder, "var", "lib", "apt", "lists")
         try:
-            self._cache.update()
-        except Exception as ex:
-            print("\nCache update error ignored : %s\n" % (ex))
+            paths = [os.path.join(lists, f) for f in sorted(os.listdir(lists))]
+        except OSError:
+            paths = []
+        paths.append(os.path.join(self._folder, "var", "lib", "dpkg", "status"))
 
-        self._cache.open()
+        for path in paths:
+            try:
+                with open(path, "rb") as f:
+                    digest.update(path + "\n")
+                    for block in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(block)
+            except IOError:
+                continue
+
+        return digest.hexdigest()
+
+    def _load_lock(self, names):
+        """
+        Return the list of (:class:`apt.Package`, :class:`apt.Version`)
+        recorded by the lock file for :param:`names`, or ``None`` if
+        there is no usable lock file
+        """
+        try:
+            with open(self._lock_file) as f:
+                lock = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if lock.get('inputs_hash') != self._inputs_hash \
+                or lock.get('names') != list(names):
+            return None
+
+        resolved = []
+        for name, version in lock.get('resolved', []):
+            try:
+                pkg = self._cache[name]
+            except KeyError:
+                return None
+            v = pkg.versions.get(version)
+            if v is None:
+                return None
+            resolved.append((pkg, v))
+
+        return resolved
+
+    def _save_lock(self, names):
+        """
+        Record the packages marked for install, upgrade or downgrade
+        by resolving :param:`names` in the lock file
+        """
+        resolved = [(pkg.name, pkg.candidate.version)
+                    for pkg in self._cache.get_changes()
+                    if not pkg.marked_delete]
+        lock = {
+            'inputs_hash': self._inputs_hash,
+            'names': list(names),
+            'resolved': resolved,
+        }
+        try:
+            with open(self._lock_file, "w") as f:
+                json.dump(lock, f)
+        except IOError as ex:
+            logger.warning("Unable to write %s: %s", self._lock_file, ex)
+
+    @staticmethod
+    def _read_file(path):
+        """
+        Return the contents of :param:`path`, or ``None`` if it can't
+        be read
+        """
+        try:
+            with open(path) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _lists_current(self, sources_list, ttl):
+        """
+        Return ``True`` if the package lists were updated from
+        :param:`sources_list` less than :param:`ttl` seconds ago
+        """
+        if ttl <= 0:
+            return False
+
+        try:
+            if os.stat(self._lists_stamp).st_mtime < time.time() - ttl:
+                return False
+        except OSError:
+            return False
+
+        return self._read_file(self._lists_stamp) == sources_list
+
+    @staticmethod
+    def _copy_tree(src, dst):
+        """
+        Copy directory tree :param:`src` to :param:`dst`, which must not
+        exist, preserving symlinks.  GNU cp is used so that the copy is a
+        reflink (copy-on-write clone) where the filesystem supports it,
+        falling back to :func:`shutil.copytree` where cp can't do this.
+        """
+        parent = os.path.dirname(dst)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+        try:
+            subprocess.check_call(["cp", "-a", "--reflink=auto", src, dst])
+        except (OSError, subprocess.CalledProcessError) as ex:
+            logger.debug("cp --reflink failed, using copytree: %s", ex)
+            shutil.rmtree(dst, ignore_errors=True)
+            shutil.copytree(src, dst, symlinks=True)
 
     def __enter__(self):
         return self
@@ -264,6 +463,8 @@ class OpxPackages(object):
 
         dump metadata from :class:`apt_pkg.Package` object
         """
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
 
         logger.debug("%s:", pkg.name)
         logger.debug("  marked_delete:     %s",
@@ -289,12 +490,21 @@ class OpxPackages(object):
         logger.debug("  is_upgradable      %s",
                      self._depcache.is_upgradable(pkg))
 
-    def _fetch_package(self, pkg, from_user=False, backtrace=[]):
+    def _get_targets(self, dep):
+        """
+        Return :meth:`apt_pkg.Dependency.all_targets` of :param:`dep`,
+        computed once for each distinct dependency
         """
-        Get the dependencies of the package's desired (candidate)
-        version and compute the set of dependent packages. If the
-        dependent package is not already installed, recursively
-        invoke this function.
+        key = (dep.target_pkg.id, dep.target_ver, dep.comp_type)
+        targets = self._all_targets_cache.get(key)
+        if targets is None:
+            targets = self._all_targets_cache[key] = dep.all_targets()
+        return targets
+
+    def _dependency_candidates(self, pkg, version):
+        """
+        Compute the candidate versions satisfying each dependency of
+        :param:`version` of :param:`pkg`.
 
         :meth:`apt_pkg.Dependency.all_targets` returns the set of
         dependent package versions that that satisfy a dependency.
@@ -304,130 +514,223 @@ class OpxPackages(object):
         the set of dependent packages which satisfy all of the
         dependencies.
 
-        This is done with two dictionaries.  pkg_versions is the
-        dictionary of all dependent packages and versions, while
-        dep_versions is the dictionary of packages and versions
-        for a single :class:`apt.pkg.Dependency`.
+        This is done by collecting the set of versions satisfying
+        each :class:`apt.pkg.Dependency` by dependent package, then
+        intersecting each package's sets into the dictionary of all
+        dependent packages and versions, pkg_versions.
+
+        :returns: list of (dependency name, list of the best
+           :class:`VersionWrapper` of each package providing it)
 
         TODO: This function only handles simple dependencies,
         not Breaks, Conflicts, or Replaces.
         """
-
-        version = self._depcache.get_candidate_ver(pkg)
-        logger.debug("version: %s", version)
-        logger.debug("    %s", backtrace)
-
-        if 'Depends' in version.depends_list:
-            pkg_versions = dict()
-            for or_deps in version.depends_list["Depends"]:
-                logger.debug("or_deps: %s", or_deps)
-
-                # In general, this script does not handle "or"
-                # dependencies. However, We have special cased
-                # makedev/udev and debconf/debconf-2.0 to make
-                # it good enough for NGOS image creation until
-                # it can.
-                if len(or_deps) != 1:
-                    logger.debug("pre: %s", or_deps)
-                    or_deps = [dep for dep in or_deps
-                               if dep.target_pkg.name
-                                    not in ('makedev', 'debconf-2.0')]
-                    logger.debug("post: %s", or_deps)
-
-                if len(or_deps) != 1:
-                    raise OpxPackagesError("Can't handle or-dependencies")
-
-                for dep in or_deps:
-                    logger.debug("dep: %s", dep)
-
-                    logger.debug("%s is satisfied by:", dep.target_pkg.name)
-                    for v in dep.all_targets():
-                        logger.debug("    %s", v)
-
-                    dep_versions = collections.defaultdict(set)
-                    for v in dep.all_targets():
-                        dep_versions[dep.target_pkg.name].add(VersionWrapper(v))
-
-                for name, versions in dep_versions.items():
-                    if not name in pkg_versions:
-                        pkg_versions[name] = set(versions)
-                    else:
-                        pkg_versions[name] &= versions
-
-            # We now have list of :class:`apt_pkg.Version` objects that satisfy
-            # the dependencies for the package.  Next we identify what packages
-            # may need to be installed.
-            for name, versions in pkg_versions.items():
-                logger.debug("pkg_versions: %s -> %s", pkg.name, name)
-                if len(versions) == 0:
-                    raise OpxPackagesError(
-                        "Unable to satisfy dependency: %s %s" %
-                        (pkg.name, name))
-
-                # Identify a list of candidate packages
-                logger.debug("start iterating group")
-                candidate_versions = []
-                sv = sorted(versions, key=lambda x: x._ver.parent_pkg.name)
-                for k, vx in itertools.groupby(sv,
-                                        key=lambda x: x._ver.parent_pkg.name):
-                    # change vx from an iterator to a list, as we need to
-                    # traverse it multiple times
-                    vx = list(vx)
-
-                    # While the library returns the versions in order, the
-                    # set operations destroy that order.  So use the Loose
-                    # Version() function from distutils to sort
-                    best_v = sorted(vx,
-                                    key=lambda x: LooseVersion(x.ver_str),
-                                    reverse=True)
-
+        if 'Depends' not in version.depends_list:
+            return []
+
+        dep_version_sets = collections.defaultdict(list)
+        for or_deps in version.depends_list["Depends"]:
+            logger.debug("or_deps: %s", or_deps)
+
+            # In general, this script does not handle "or"
+            # dependencies. However, We have special cased
+            # makedev/udev and debconf/debconf-2.0 to make
+            # it good enough for NGOS image creation until
+            # it can.
+            if len(or_deps) != 1:
+                logger.debug("pre: %s", or_deps)
+                or_deps = [dep for dep in or_deps
+                           if dep.target_pkg.name not in SPECIAL_OR]
+                logger.debug("post: %s", or_deps)
+
+            if len(or_deps) != 1:
+                raise OpxPackagesError("Can't handle or-dependencies")
+
+            dep = or_deps[0]
+            logger.debug("dep: %s", dep)
+
+            targets = self._get_targets(dep)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s is satisfied by:", dep.target_pkg.name)
+                for v in targets:
+                    logger.debug("    %s", v)
+
+            dep_version_sets[dep.target_pkg.name].append(
+                {VersionWrapper(v) for v in targets})
+
+        pkg_versions = dict((name, set.intersection(*sets))
+                            for name, sets in dep_version_sets.items())
+
+        # We now have list of :class:`apt_pkg.Version` objects that satisfy
+        # the dependencies for the package.  Next we identify the best
+        # version of each package that may need to be installed.
+        candidates = []
+        for name, versions in pkg_versions.items():
+            logger.debug("pkg_versions: %s -> %s", pkg.name, name)
+            if len(versions) == 0:
+                raise OpxPackagesError(
+                    "Unable to satisfy dependency: %s %s" %
+                    (pkg.name, name))
+
+            # Identify a list of candidate packages
+            logger.debug("start iterating group")
+            candidate_versions = []
+            groups = collections.defaultdict(list)
+            for v in versions:
+                groups[v._ver.parent_pkg.name].append(v)
+
+            # Visit the packages in name order, so that the first
+            # candidate (the one selected if none are installed) does
+            # not depend on set iteration order
+            for k in sorted(groups):
+                vx = groups[k]
+
+                # While the library returns the versions in order, the
+                # set operations destroy that order.  So use apt's own
+                # Debian version comparison to pick the highest
+                if logger.isEnabledFor(logging.DEBUG):
                     logger.debug("%s", k)
-                    for v in best_v:
+                    for v in vx:
                         logger.debug("    %s", v.ver_str)
 
-                    best_v = best_v[0]
-                    logger.debug("best candidate is %s", best_v)
-                    candidate_versions.append(best_v)
-                logger.debug("done iterating group")
+                best_v = max(vx, key=_debian_version_key)
+                logger.debug("best candidate is %s", best_v)
+                candidate_versions.append(best_v)
+            logger.debug("done iterating group")
+
+            candidates.append((name, candidate_versions))
+
+        return candidates
 
-                # Determine whether any of the candidates are already installed
-                installed = False
+    def _build_graph(self, root_pkg):
+        """
+        Explore the dependencies of the candidate version of
+        :param:`root_pkg`, and of every package that needs to be
+        installed to satisfy them, selecting the version of each.
+
+        A dependency is already satisfied when one of its candidates
+        is installed, marked for install, or part of the graph.
+        Otherwise the first candidate is selected (we don't have a
+        mechanism to indicate a preference) and explored in turn.
+
+        :returns: (graph, nodes) where graph maps each package id to
+           the ids of the graph packages it depends on, and nodes is
+           an ordered dict of package id to :class:`apt_pkg.Package`
+           in the order they were discovered
+        """
+        # The walk runs once per requested package over its whole
+        #  dependency closure, so keep the invariants in locals
+        depcache = self._depcache
+        get_candidate_ver = depcache.get_candidate_ver
+        marked_install = depcache.marked_install
+        dependency_candidates = self._dependency_candidates
+        not_installed = apt_pkg.CURSTATE_NOT_INSTALLED
+
+        graph = dict()
+        nodes = collections.OrderedDict()
+        nodes[root_pkg.id] = root_pkg
+
+        queue = collections.deque([root_pkg])
+        while queue:
+            pkg = queue.popleft()
+            version = get_candidate_ver(pkg)
+            logger.debug("version: %s", version)
+
+            deps = graph[pkg.id] = []
+            for name, candidate_versions in dependency_candidates(pkg,
+                                                                  version):
+                # Determine whether any of the candidates are already
+                # installed, or will be
                 for v in candidate_versions:
                     dep_pkg = v.parent_pkg
-                    if dep_pkg.id in [xpkg.id for xpkg in backtrace]:
-                        installed = True
+                    if dep_pkg.id in nodes:
+                        deps.append(dep_pkg.id)
                         break
-                    if dep_pkg.current_state != apt_pkg.CURSTATE_NOT_INSTALLED:
-                        installed = True
+                    if dep_pkg.current_state != not_installed:
                         break
-                    if self._depcache.marked_install(dep_pkg):
-                        installed = True
+                    if marked_install(dep_pkg):
                         break
-
-                # If dependent package is not installed, then select the first
-                # (we don't have a mechanism to indicate a preference), then
-                # recurse.
-                if not installed:
+                else:
                     v = candidate_versions[0]
+                    dep_pkg = v.parent_pkg
 
                     logger.debug("\t will fetch %s %s",
-                                 v.parent_pkg.name, v.ver_str)
+                                 dep_pkg.name, v.ver_str)
 
-                    self._depcache.set_candidate_ver(dep_pkg, v._ver)
-                    self._fetch_package(dep_pkg, backtrace=[pkg]+backtrace)
+                    depcache.set_candidate_ver(dep_pkg, v._ver)
+                    nodes[dep_pkg.id] = dep_pkg
+                    deps.append(dep_pkg.id)
+                    queue.append(dep_pkg)
 
-        logger.debug("marking %s for install", pkg)
+        return graph, nodes
 
-        try:
-            self._depcache.mark_install(pkg, False, from_user)
-        except SystemError as ex:
-            raise OpxPackagesError, OpxPackagesError(ex), sys.exc_info()[2]
+    @staticmethod
+    def _topo_sort(graph, nodes):
+        """
+        Yield the package ids of :param:`nodes` so that each package
+        comes after the packages it depends on (Kahn's algorithm).
 
-    def fetch(self, names):
+        Packages in a dependency cycle can't be ordered that way; they
+        are yielded last, most recently discovered first.
         """
-        Fetch packages
+        pending = dict()
+        dependents = collections.defaultdict(list)
+        for pkg_id, deps in graph.items():
+            deps = set(deps)
+            pending[pkg_id] = len(deps)
+            for dep_id in deps:
+                dependents[dep_id].append(pkg_id)
+
+        ready = collections.deque(pkg_id for pkg_id in nodes
+                                        if pending[pkg_id] == 0)
+        done = set()
+        while ready:
+            pkg_id = ready.popleft()
+            done.add(pkg_id)
+            yield pkg_id
+            for dependent_id in dependents[pkg_id]:
+                pending[dependent_id] -= 1
+                if pending[dependent_id] == 0:
+                    ready.append(dependent_id)
+
+        for pkg_id in reversed(nodes):
+            if pkg_id not in done:
+                yield pkg_id
+
+    def _fetch_package(self, pkg, from_user=False):
+        """
+        Select the package's desired (candidate) version and that of
+        every package needed to satisfy its dependencies, then mark
+        them all for install, dependencies first.
+        """
+        depcache = self._depcache
+        fetched = self._fetched
 
-        Fetch specified and all dependent packages.
+        version = depcache.get_candidate_ver(pkg)
+
+        # A package version reached again only needs its dependencies
+        # resolved once
+        if (pkg.id, version.ver_str) in fetched:
+            logger.debug("%s %s already fetched", pkg.name, version.ver_str)
+            return
+
+        graph, nodes = self._build_graph(pkg)
+
+        for pkg_id in self._topo_sort(graph, nodes):
+            node = nodes[pkg_id]
+            logger.debug("marking %s for install", node)
+
+            try:
+                depcache.mark_install(node, False,
+                                      from_user and pkg_id == pkg.id)
+            except SystemError as ex:
+                raise OpxPackagesError, OpxPackagesError(ex), sys.exc_info()[2]
+
+            fetched.add((pkg_id, depcache.get_candidate_ver(node).ver_str))
+
+    def _resolve(self, names):
+        """
+        Mark specified and all dependent packages for install.
         """
 
         # There may be more than one revision specification for a package.
@@ -444,14 +747,19 @@ class OpxPackages(object):
 
         for package_name in depends.keys():
             try:
-                pkg = self._cache[package_name]
+                pkg, versions_list = self._pkg_lookup[package_name]
             except KeyError:
-                msg = "Can't find %s in package cache" % package_name
-                raise OpxPackagesError, OpxPackagesError(msg), sys.exc_info()[2]
+                try:
+                    pkg = self._cache[package_name]
+                except KeyError:
+                    msg = "Can't find %s in package cache" % package_name
+                    raise OpxPackagesError, OpxPackagesError(msg), sys.exc_info()[2]
+                versions_list = list(pkg.versions)
+                self._pkg_lookup[package_name] = (pkg, versions_list)
 
             # find a version that satisfies the revision specification
             found = False
-            for v in pkg.versions:
+            for v in versions_list:
                 satisfied = True
 
                 for dep in depends[package_name]:
@@ -490,6 +798,28 @@ class OpxPackages(object):
             if not found:
                 raise OpxPackagesError("Failed to locate %s that satisfies revision specifications" % package_name)
 
+    def fetch(self, names):
+        """
+        Fetch packages
+
+        Fetch specified and all dependent packages.
+
+        If the lock file records a resolution of the same names from
+        the same package lists, its packages are marked for install
+        directly instead of resolving the dependencies again.
+        """
+        resolved = self._load_lock(names)
+        if resolved is None:
+            self._resolve(names)
+        else:
+            print("Using package versions resolved by the previous fetch")
+            for pkg, v in resolved:
+                pkg.candidate = v
+                try:
+                    self._depcache.mark_install(pkg._pkg, False, False)
+                except SystemError as ex:
+                    raise OpxPackagesError, OpxPackagesError(ex), sys.exc_info()[2]
+
         if self._depcache.broken_count:
             logger.info("Attempting to fix %s broken packages",
                         self._depcache.broken_count)
@@ -510,31 +840,75 @@ class OpxPackages(object):
             msg = "Fetch cancelled"
             raise OpxPackagesError, OpxPackagesError(msg), sys.exc_info()[2]
 
-    def install(self):
+        if resolved is None:
+            self._save_lock(names)
+
+    def _iter_debs(self):
+        """
+        Yield the path of each package archive in the package cache
+        """
+        for f in os.listdir(self._apt_cache):
+            if f.endswith('.deb'):
+                yield os.path.join(self._apt_cache, f)
+
+    def _unpack(self, debfile):
+        """
+        Unpack a single package archive into the sysroot
+        """
+        l = ["dpkg", "-x", debfile, self._folder]
+        print(l)
+        try:
+            subprocess.check_call(l)
+        except subprocess.CalledProcessError as ex:
+            logger.error("dpkg -x %s failed", debfile)
+            logger.exception(ex)
+
+    def install(self, parallel_jobs=DEFAULT_PARALLEL_JOBS):
         """
         Install packages
 
         Install packages in the package cache.
+
+        :param parallel_jobs:
+           Number of archives to unpack concurrently.
         """
-        for debfile in [os.path.join(self._apt_cache, f)
-                        for f in os.listdir(self._apt_cache)
-                                    if f.endswith('.deb')]:
+        debs = list(self._iter_debs())
+        if not debs:
+            return
 
-            l = ["dpkg", "-x", debfile, self._folder]
-            print(l)
-            try:
-                subprocess.check_call(l)
-            except subprocess.CalledProcessError as ex:
-                logger.error("dpkg -x %s failed", debfile)
-                logger.exception(ex)
+        jobs = max(1, parallel_jobs)
+
+        # Hand the whole batch to a single xargs, which runs the dpkg
+        # processes itself, rather than managing one per archive here
+        l = ["xargs", "-0", "-P", str(jobs), "-I{}",
+             "dpkg", "-x", "{}", self._folder]
+        print(l)
+        try:
+            proc = subprocess.Popen(l, stdin=subprocess.PIPE)
+            proc.communicate("\0".join(debs))
+            if proc.returncode == 0:
+                return
+            logger.warning("batched unpack failed (exit status %d)",
+                           proc.returncode)
+        except OSError as ex:
+            logger.warning("batched unpack failed: %s", ex)
+
+        # Unpack again one archive at a time to report which ones fail;
+        # dpkg -x simply overwrites what was already extracted.
+        # Each archive is unpacked by its own dpkg process, so the
+        # work is I/O and fork/exec bound and threads are sufficient
+        pool = ThreadPool(jobs)
+        try:
+            pool.map(self._unpack, debs)
+        finally:
+            pool.close()
+            pool.join()
 
     def clean(self):
         """
         Remove files from package cache
         """
-        for debfile in [os.path.join(self._apt_cache, f)
-                        for f in os.listdir(self._apt_cache)
-                                    if f.endswith('.deb')]:
+        for debfile in self._iter_debs():
             os.remove(debfile)
 
 
@@ -591,6 +965,17 @@ def main():
     parser.add_argument('--component',
                         help="package component",
                         default=DEFAULT_PKG_COMPONENT)
+    parser.add_argument('-j', '--parallel-jobs',
+                        dest='parallel_jobs',
+                        help="number of packages to unpack concurrently",
+                        type=int, default=DEFAULT_PARALLEL_JOBS)
+    parser.add_argument('--cache-ttl',
+                        dest='cache_ttl',
+                        help="seconds to reuse package lists before updating, 0 to always update",
+                        type=int, default=DEFAULT_CACHE_TTL)
+    parser.add_argument('--memonly',
+                        help="build the package cache in memory only, without keeping pkgcache.bin",
+                        action='store_true')
     parser.add_argument('-p', '--package_list',
                         help="comma separated list of packages")
     parser.add_argument('--default_solver', action='store_true',
@@ -616,12 +1001,14 @@ def main():
                         default_solver=args.default_solver,
                         sysrootdev=args.sysrootdev,
                         install_recommends=args.install_recommends,
-                        install_suggests=args.install_suggests) as ar:
+                        install_suggests=args.install_suggests,
+                        cache_ttl=args.cache_ttl,
+                        memonly=args.memonly) as ar:
 
             if args.package_list:
                 ar.fetch(names=args.package_list.split(','))
                 if not args.download_only:
-                    ar.install()
+                    ar.install(parallel_jobs=args.parallel_jobs)
             else:
                 ar.list_packages()
 
@@ -12,11 +12,10 @@ import collections
 import datetime
 import errno
 import fileinput
-import glob
-import hashlib
 import jinja2
 import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
@@ -25,6 +24,8 @@ import subprocess
 import sys
 import time
 
+from multiprocessing.pool import ThreadPool
+
 from lxml import etree
 from lxml.builder import E
 
@@ -36,6 +37,27 @@ build_num = 99999
 build_suffix = ""
 verbosity = 0
 
+# Package name and revision specification in a legacy blueprint
+_LEGACY_PKG_RE = re.compile(
+    r'\A([a-zA-Z0-9][a-zA-Z0-9+-.]+)\s*(?:\(\s*(<<|<=|!=|=|>=|>>)\s*([0-9][a-z0-9+-.:~]+)\s*\))?\s*\Z')
+# Blueprint version range specification, and the version within an
+# equality or inequality specification
+_RANGE_RE = re.compile(
+    r'\A([[(])([0-9][a-z0-9+-.:~]+)?,([0-9][a-z0-9+-.:~]+)?([])])\Z')
+_VERSION_TOKEN_RE = re.compile(r'\A[0-9][a-z0-9+-.:~]+\Z')
+# Debian relation -> (has lower bound, lower bound inclusive,
+#                     has upper bound, upper bound inclusive)
+_RELATION_BOUNDS = {
+    '<<': (False, False, True, False),
+    '<=': (False, False, True, True),
+    '!=': (True, False, True, False),
+    '=': (True, True, True, True),
+    '>=': (True, True, False, False),
+    '>>': (True, False, False, False),
+}
+# NAME=value line of the version info
+_EQ_SPLIT_RE = re.compile(r'=')
+
 def _str2bool(s):
     """
     Convert string to boolean
@@ -52,6 +74,18 @@ def _str2bool(s):
     raise ValueError("Invalid boolean value %r" % (s))
 
 
+def _child_elements(elem):
+    """
+    Map the tag of each child of elem to the first child with that tag,
+    like :meth:`etree._Element.find` by tag but in a single pass
+    """
+
+    children = {}
+    for child in elem:
+        children.setdefault(child.tag, child)
+    return children
+
+
 def _bool2str(b):
     """
     Convert boolean to string
@@ -62,6 +96,73 @@ def _bool2str(b):
     return "true" if b else "false"
 
 
+# Digests recorded for artifacts and dependencies in the build info.
+# Artifactory requires md5 and sha1; sha256 is also accepted, and is
+# the one checksum here with hardware support on current CPUs.
+_BUILD_INFO_HASHES = ('md5', 'sha1', 'sha256')
+
+# Environment variables recorded as build info properties: the CI
+# job and source identifiers, plus anything with one of the prefixes
+_BUILD_INFO_ENV = frozenset((
+    'BUILD_NUMBER', 'BUILD_URL', 'JOB_NAME', 'JOB_URL', 'NODE_NAME',
+    'GIT_BRANCH', 'GIT_COMMIT', 'GIT_URL', 'DIST', 'ARCH',
+))
+_BUILD_INFO_ENV_PREFIXES = ('BUILDINFO_ENV_', 'bamboo_', 'OPX_', 'INSTALLER_')
+
+# inst-hooks setting the apt sources, and the repository whose
+# distribution is changed to the one being built
+_APT_SOURCES_HOOKS = {
+    '98-set-apt-sources.postinst.sh': 'openswitch.net/jessie',
+    '98-set-apt-sources.stretch.postinst.sh': 'openswitch.net/stretch',
+}
+
+# Build date and copyright notice recorded in the release version info
+_BUILD_DATE = os.environ.get('bamboo_buildTimeStamp',
+                             time.strftime('%FT%T%z'))
+_COPYRIGHT = "Copyright (c) 1999-%4d by Dell EMC Inc. All Rights Reserved." \
+             % (time.localtime().tm_year)
+
+# Scripts and templates shipped alongside this one
+_SCRIPTS_DIR = os.path.dirname(__file__)
+_TEMPLATES_DIR = os.path.join(_SCRIPTS_DIR, 'templates')
+_APT_UPGRADE_SH = os.path.join(_TEMPLATES_DIR, 'do_apt_upgrade_sh')
+_DPKG_SH = os.path.join(_TEMPLATES_DIR, 'do_dpkg_sh')
+_IDX_PKGS = os.path.join(_SCRIPTS_DIR, 'idx-pkgs')
+
+# Jinja2 environment used for template expansion.  Templates are
+# compiled on first use and, with auto_reload off, never re-checked.
+_JINJA_ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(_TEMPLATES_DIR),
+    auto_reload=False)
+
+_FILEMODE_BITS = (
+    (stat.S_IRUSR, 'r'), (stat.S_IWUSR, 'w'), (stat.S_IXUSR, 'x'),
+    (stat.S_IRGRP, 'r'), (stat.S_IWGRP, 'w'), (stat.S_IXGRP, 'x'),
+    (stat.S_IROTH, 'r'), (stat.S_IWOTH, 'w'), (stat.S_IXOTH, 'x'),
+)
+
+
+def _ls_l(pathname):
+    """
+    Return a line describing pathname like that printed by ls -l,
+    with numeric owner and group
+    """
+    st = os.lstat(pathname)
+    if stat.S_ISDIR(st.st_mode):
+        kind = 'd'
+    elif stat.S_ISLNK(st.st_mode):
+        kind = 'l'
+    else:
+        kind = '-'
+    mode = kind + ''.join(c if st.st_mode & bit else '-'
+                          for bit, c in _FILEMODE_BITS)
+
+    return "%s %d %d %d %d %s %s" % (
+        mode, st.st_nlink, st.st_uid, st.st_gid, st.st_size,
+        time.strftime('%b %d %H:%M', time.localtime(st.st_mtime)),
+        pathname)
+
+
 def art8601_format(dt):
     """
     Format datetime object in ISO 8601 format suitable for Artifactory.
@@ -77,14 +178,7 @@ def art8601_format(dt):
     Code adapted from standard python library.
     """
 
-    s = '%04d-%02d-%02dT%02d:%02d:%02d.%03d' % (
-        dt.year,
-        dt.month,
-        dt.day,
-        dt.hour,
-        dt.minute,
-        dt.second,
-        dt.microsecond / 1000)
+    s = dt.strftime('%Y-%m-%dT%H:%M:%S') + '.%03d' % (dt.microsecond // 1000)
 
     utc_offset = dt.utcoffset()
     if utc_offset is not None:
@@ -110,6 +204,9 @@ class OpxRelPackageRestriction(object):
 
     Loosely based on Maven's Restriction object API.
     """
+    __slots__ = ('lower_bound', 'lower_bound_inclusive',
+                 'upper_bound', 'upper_bound_inclusive')
+
     def __init__(self, lower_bound,
                  lower_bound_inclusive,
                  upper_bound,
@@ -136,19 +233,20 @@ class OpxRelPackageRestriction(object):
                 not self.upper_bound_inclusive):
             return ['!=' + self.lower_bound]
 
-        restrictions = list()
-        if self.lower_bound is not None:
-            if self.lower_bound_inclusive:
-                restrictions.append('>=' + self.lower_bound)
-            else:
-                restrictions.append('>>' + self.lower_bound)
-        if self.upper_bound is not None:
-            if self.upper_bound_inclusive:
-                restrictions.append('<=' + self.upper_bound)
-            else:
-                restrictions.append('<<' + self.upper_bound)
-
-        return restrictions
+        # most restrictions have a single bound
+        if self.upper_bound is None:
+            if self.lower_bound is None:
+                return []
+            return [('>=' if self.lower_bound_inclusive else '>>')
+                    + self.lower_bound]
+        if self.lower_bound is None:
+            return [('<=' if self.upper_bound_inclusive else '<<')
+                    + self.upper_bound]
+
+        return [('>=' if self.lower_bound_inclusive else '>>')
+                + self.lower_bound,
+                ('<=' if self.upper_bound_inclusive else '<<')
+                + self.upper_bound]
 
     def __str__(self):
         """
@@ -181,6 +279,7 @@ class OpxRelPackage(object):
     """
     Defines a package in a :class:`OpxRelPackageSet`.
     """
+    __slots__ = ('name', 'restriction')
 
     def __init__(self, name, restriction):
         self.name = name
@@ -203,7 +302,7 @@ class OpxRelPackage(object):
         #    wrong choice, it's easy enough to change.
 
         if elem.text:
-            match = re.match(r'\A([a-zA-Z0-9][a-zA-Z0-9+-.]+)\s*(?:\(\s*(<<|<=|!=|=|>=|>>)\s*([0-9][a-z0-9+-.:~]+)\s*\))?\s*\Z', elem.text)
+            match = _LEGACY_PKG_RE.match(elem.text)
             if not match:
                 raise ValueError("Can't parse version: ->%s<-" % elem.text)
 
@@ -214,36 +313,10 @@ class OpxRelPackage(object):
             restriction = None
 
             if relation:
-                if relation == '<<':
-                    lower_bound = None
-                    lower_bound_inclusive = False
-                    upper_bound = version
-                    upper_bound_inclusive = False
-                elif relation == '<=':
-                    lower_bound = None
-                    lower_bound_inclusive = False
-                    upper_bound = version
-                    upper_bound_inclusive = True
-                elif relation == '!=':
-                    lower_bound = version
-                    lower_bound_inclusive = False
-                    upper_bound = version
-                    lower_bound_inclusive = False
-                elif relation == '=':
-                    lower_bound = version
-                    lower_bound_inclusive = True
-                    upper_bound = version
-                    lower_bound_inclusive = True
-                elif relation == '>=':
-                    lower_bound = version
-                    lower_bound_inclusive = True
-                    upper_bound = None
-                    upper_bound_inclusive = False
-                elif relation == '>>':
-                    lower_bound = version
-                    lower_bound_inclusive = True
-                    upper_bound = None
-                    upper_bound_inclusive = False
+                (has_lower, lower_bound_inclusive,
+                 has_upper, upper_bound_inclusive) = _RELATION_BOUNDS[relation]
+                lower_bound = version if has_lower else None
+                upper_bound = version if has_upper else None
 
                 restriction = OpxRelPackageRestriction(
                     lower_bound,
@@ -258,34 +331,29 @@ class OpxRelPackage(object):
         if not version:
             return OpxRelPackage(name, None)
 
-        match = re.match(r'\A([[(])([0-9][a-z0-9+-.:~]+)?,([0-9][a-z0-9+-.:~]+)?([])])\Z', version)
-        if match:
-            restriction = OpxRelPackageRestriction(
-                match.group(2),
-                match.group(1) == '[',
-                match.group(3),
-                match.group(4) == ']')
-            return OpxRelPackage(name, restriction)
-
-        # special case equality
-        match = re.match(r'\A\[([0-9][a-z0-9+-.:~]+)\]\Z', version)
-        if match:
-            restriction = OpxRelPackageRestriction(
-                match.group(1),
-                True,
-                match.group(1),
-                True)
-            return OpxRelPackage(name, restriction)
-
-        # special case inequality
-        match = re.match(r'\A\(([0-9][a-z0-9+-.:~]+)\)\Z', version)
-        if match:
-            restriction = OpxRelPackageRestriction(
-                match.group(1),
-                False,
-                match.group(1),
-                False)
-            return OpxRelPackage(name, restriction)
+        # a range always contains a comma
+        if ',' in version:
+            match = _RANGE_RE.match(version)
+            if match:
+                restriction = OpxRelPackageRestriction(
+                    match.group(2),
+                    match.group(1) == '[',
+                    match.group(3),
+                    match.group(4) == ']')
+                return OpxRelPackage(name, restriction)
+
+        # special case equality, [version], and inequality, (version)
+        brackets = version[:1] + version[-1:]
+        if brackets in ('[]', '()'):
+            inner = version[1:-1]
+            if _VERSION_TOKEN_RE.match(inner):
+                inclusive = brackets == '[]'
+                restriction = OpxRelPackageRestriction(
+                    inner,
+                    inclusive,
+                    inner,
+                    inclusive)
+                return OpxRelPackage(name, restriction)
 
         raise ValueError("Can't parse version: ->%s<-" % version)
 
@@ -328,6 +396,8 @@ class OpxRelPackageList(object):
     """
     Defines a list of packages, each one being an :class:`OpxRelPackage`
     """
+    __slots__ = ('packages', 'no_package_filter')
+
     def __init__(self, package_list, no_package_filter=False):
         self.packages = package_list
         self.no_package_filter = no_package_filter
@@ -370,6 +440,9 @@ class OpxRelPackageSet(object):
     Defines a package set, including a list of packages,
      and where to find/get them.
     """
+    __slots__ = ('name', 'kind', 'default_solver', 'platform', 'flavor',
+                 'package_sources', 'package_lists')
+
     def __init__(self, name, kind, default_solver, platform, flavor,
                     package_sources, package_lists):
         self.name = name
@@ -386,38 +459,41 @@ class OpxRelPackageSet(object):
         Construct :class:`OpxRelPackageSet` object from :class:`etree.Element`
         """
 
-        name = elem.find('name').text
-        kind = elem.find('type').text
+        children = _child_elements(elem)
+
+        name = children.get('name').text
+        kind = children.get('type').text
 
-        if elem.find('default_solver') is not None:
+        if children.get('default_solver') is not None:
             default_solver = True
         else:
             default_solver = False
 
-        _tmp = elem.find('platform')
+        _tmp = children.get('platform')
         if _tmp is not None:
             platform = _tmp.text
         else:
             platform = None
 
-        _tmp = elem.find('flavor')
+        _tmp = children.get('flavor')
         if _tmp is not None:
             flavor = _tmp.text
         else:
             flavor = None
 
         package_sources = []
-        for package_desc_elem in elem.findall('package_desc'):
+        for package_desc_elem in elem.iterchildren('package_desc'):
+            desc_children = _child_elements(package_desc_elem)
             package_sources.append(
                 opx_get_packages.OpxPackageSource(
-                    package_desc_elem.find('url').text,
-                    package_desc_elem.find('distribution').text,
-                    package_desc_elem.find('component').text,
+                    desc_children.get('url').text,
+                    desc_children.get('distribution').text,
+                    desc_children.get('component').text,
                 )
             )
 
         package_lists = []
-        for package_list_elem in elem.findall('package_list'):
+        for package_list_elem in elem.iterchildren('package_list'):
             package_lists.append(OpxRelPackageList.fromElement(
                                                         package_list_elem))
 
@@ -463,39 +539,43 @@ class OpxRelPackageSet(object):
         Override str method for a pretty format of the Data members
 
         """
-        mstr = "\n" + self.__class__.__name__
-        mstr += " is an OpxRelPackageSet() instance\n"
-        mstr += "\t" + self.name + "\n"
-        mstr += "\twhich is a " + self.kind + "\n"
-        mstr += "\tsources:\n"
+        parts = ["\n", self.__class__.__name__,
+                 " is an OpxRelPackageSet() instance\n",
+                 "\t", self.name, "\n",
+                 "\twhich is a ", self.kind, "\n",
+                 "\tsources:\n"]
         for src in self.package_sources:
-            mstr += "\t\t%s [%s,%s]\n" % (
+            parts.append("\t\t%s [%s,%s]\n" % (
                 src.url,
                 src.distribution,
                 src.component
-            )
-        mstr += "\tpackages:\n"
+            ))
+        parts.append("\tpackages:\n")
         for pkg_list in self.package_lists:
             for pkg in pkg_list.packages:
-                mstr += "\t\t" + str(pkg) + "\n"
-            mstr += "\n"
+                parts.append("\t\t" + str(pkg) + "\n")
+            parts.append("\n")
 
-        return mstr
+        return "".join(parts)
 
 
 class OpxRelInstHook(object):
     """
     Installation hook file in an OPX release
     """
+    __slots__ = ('hook_file', 'hook_file_path')
+
     def __init__(self, hook_file):
         hook_file_path = os.path.join('opx-onie-installer', 'inst-hooks',
                                       hook_file)
-        if not os.path.exists(hook_file_path):
+        try:
+            st = os.stat(hook_file_path)
+        except OSError:
             print("Hook file %s does not exist" % hook_file_path,
                   file=sys.stderr)
             sys.exit(1)
 
-        if not os.access(hook_file_path, os.X_OK):
+        if not st.st_mode & (stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH):
             print("Hook file %s is not executable" % hook_file_path,
                   file=sys.stderr)
             sys.exit(1)
@@ -554,57 +634,71 @@ class OpxRelBlueprint(object):
             sys.exit(1)
 
     @classmethod
-    def fromElement(cls, elem, dist):
+    def fromElement(cls, elem, dist, consume=False):
         """
         Construct :class:`OpxRelBlueprint` object from :class:`etree.Element`
+
+        If consume is ``True``, each package_set element is cleared once
+        it has been converted, releasing the memory of a tree that is
+        not needed afterwards.
         """
 
+        children = _child_elements(elem)
+
         try:
-            description = elem.find('description').text
-            package_type = elem.find('package_type').text
-            platform = elem.find('platform').text
-            architecture = elem.find('architecture').text
-            installer_suffix = elem.find('installer_suffix').text
-            version = elem.find('version').text
+            description = children.get('description').text
+            package_type = children.get('package_type').text
+            platform = children.get('platform').text
+            architecture = children.get('architecture').text
+            installer_suffix = children.get('installer_suffix').text
+            version = children.get('version').text
         except AttributeError:
             print("We were unable to find a required value in the XML. Verify the blueprint XML provides the following "
                   "values:\n- description\n- package_type\n- platform\n- architecture\n- installer_suffix\n- version")
             sys.exit(1)
 
-        rootfs_elem = elem.find('rootfs')
+        rootfs_children = _child_elements(children.get('rootfs'))
         rootfs = {
-            'tar_name': rootfs_elem.find('tar_name').text,
-            'source': rootfs_elem.find('source').text,
-            'location': rootfs_elem.find('location').text,
-            'url': os.path.join(rootfs_elem.find('source').text,
-                                rootfs_elem.find('tar_name').text),
+            'tar_name': rootfs_children.get('tar_name').text,
+            'source': rootfs_children.get('source').text,
+            'location': rootfs_children.get('location').text,
         }
+        rootfs['url'] = os.path.join(rootfs['source'], rootfs['tar_name'])
 
-        rootfs_md5_elem = rootfs_elem.find('md5')
+        rootfs_md5_elem = rootfs_children.get('md5')
         if rootfs_md5_elem is not None:
             rootfs['md5'] = rootfs_md5_elem.text
         else:
             rootfs['md5'] = None
 
-        rootfs_sha1_elem = rootfs_elem.find('sha1')
+        rootfs_sha1_elem = rootfs_children.get('sha1')
         if rootfs_sha1_elem is not None:
             rootfs['sha1'] = rootfs_sha1_elem.text
         else:
             rootfs['sha1'] = None
 
-        output_elem = elem.find('output_format')
+        rootfs_sha256_elem = rootfs_children.get('sha256')
+        if rootfs_sha256_elem is not None:
+            rootfs['sha256'] = rootfs_sha256_elem.text
+        else:
+            rootfs['sha256'] = None
+
+        output_children = _child_elements(children.get('output_format'))
         output_format = {
-            'name': output_elem.find('name').text,
-            'version': output_elem.find('version').text,
-            'tar_archive': _str2bool(output_elem.find('tar_archive').text),
-            'ONIE_image': _str2bool(output_elem.find('ONIE_image').text),
-            'ONIE_pkg': _str2bool(output_elem.find('ONIE_pkg').text),
-            'package_cache': _str2bool(output_elem.find('package_cache').text),
+            'name': output_children.get('name').text,
+            'version': output_children.get('version').text,
+            'tar_archive': _str2bool(output_children.get('tar_archive').text),
+            'ONIE_image': _str2bool(output_children.get('ONIE_image').text),
+            'ONIE_pkg': _str2bool(output_children.get('ONIE_pkg').text),
+            'package_cache':
+                _str2bool(output_children.get('package_cache').text),
         }
 
         package_sets = []
-        for package_set_elem in elem.findall('package_set'):
+        for package_set_elem in elem.iterchildren('package_set'):
             package_sets.append(OpxRelPackageSet.fromElement(package_set_elem))
+            if consume:
+                package_set_elem.clear()
 
         for p in package_sets:
             for s in p.package_sources:
@@ -613,7 +707,7 @@ class OpxRelBlueprint(object):
                     s.distribution = dist
 
         inst_hooks = []
-        for hook_elem in elem.findall('inst_hook'):
+        for hook_elem in elem.iterchildren('inst_hook'):
             inst_hooks.append(OpxRelInstHook.fromElement(hook_elem))
 
         return OpxRelBlueprint(description, package_type,
@@ -657,9 +751,13 @@ class OpxRelBlueprint(object):
     @classmethod
     def load_xml(cls, fd_, dist):
         tree = etree.parse(fd_)
-        tree.xinclude()
         root = tree.getroot()
-        return OpxRelBlueprint.fromElement(root, dist)
+        # only run the XInclude processor if there is something to include
+        includes = root.iter('{http://www.w3.org/2001/XInclude}include',
+                             '{http://www.w3.org/2003/XInclude}include')
+        if next(includes, None) is not None:
+            tree.xinclude()
+        return OpxRelBlueprint.fromElement(root, dist, consume=True)
 
     def dumps_xml(self):
         root = etree.Element('blueprint',
@@ -685,19 +783,20 @@ class OpxRelBlueprint(object):
         Override the str method, to get it formatted,
          possibly to dump information into a formal log
         """
-        mstr = self.__class__.__name__
-        mstr += " is a OpxRelBluePrint()\n"
-        mstr += self.description + "\n"
-        mstr += "a collection of " + self.package_type + " packages\n"
-        mstr += "Version:" + self.version + "\n"
-
-        mstr += "root file system descriptor:\n"
-        mstr += "\turl = %s\n" % (self.rootfs['url'])
+        parts = [self.__class__.__name__, " is a OpxRelBluePrint()\n",
+                 self.description, "\n",
+                 "a collection of ", self.package_type, " packages\n",
+                 "Version:", self.version, "\n"]
+
+        parts.append("root file system descriptor:\n")
+        parts.append("\turl = %s\n" % (self.rootfs['url']))
         if self.rootfs['md5']:
-            mstr += "\tmd5 = %s\n" % (self.rootfs['md5'])
+            parts.append("\tmd5 = %s\n" % (self.rootfs['md5']))
         if self.rootfs['sha1']:
-            mstr += "\tsha1 = %s\n" % (self.rootfs['sha1'])
-        mstr += "\tlocation = %s\n" % (self.rootfs['location'])
+            parts.append("\tsha1 = %s\n" % (self.rootfs['sha1']))
+        if self.rootfs['sha256']:
+            parts.append("\tsha256 = %s\n" % (self.rootfs['sha256']))
+        parts.append("\tlocation = %s\n" % (self.rootfs['location']))
 
         # print in order of creation by make_output
         name = '{}-{}{}{}'.format(
@@ -707,18 +806,18 @@ class OpxRelBlueprint(object):
             build_suffix,
         )
 
-        mstr += "creates:\n"
+        parts.append("creates:\n")
         if self.output_format['package_cache']:
-            mstr += "\t" + name + "-<specific name>-pkg_cache.tgz\n"
+            parts.append("\t" + name + "-<specific name>-pkg_cache.tgz\n")
         if self.output_format['ONIE_image'] or self.output_format['ONIE_pkg']:
-            mstr += "\t" + name + "-installer-<specific name>.bin\n"
+            parts.append("\t" + name + "-installer-<specific name>.bin\n")
         if self.output_format['tar_archive']:
-            mstr += "\t" + name + "-<specific name>-rootfs.tgz\n"
+            parts.append("\t" + name + "-<specific name>-rootfs.tgz\n")
 
         for p in self.package_sets:
-            mstr += p.__str__()
+            parts.append(p.__str__())
 
-        return mstr
+        return "".join(parts)
 
 
 class OpxRelPackageAssembler(object):
@@ -730,6 +829,13 @@ class OpxRelPackageAssembler(object):
         self._blueprint = blueprint
         self.artifacts = []
         self.dependencies = []
+        self._version_info = None
+        # names of the package archives in the rootfs package cache
+        self._archive_debs = None
+        # Debian package specifications of each package set, and the
+        # names of all the packages in the blueprint
+        self._deb_lists = None
+        self._deb_names = None
 
         # .. todo:: Need to assert current directory is ${PROJROOT} and
         # the opx-onie-installer repository is present
@@ -743,16 +849,27 @@ class OpxRelPackageAssembler(object):
             rootfs_path=None,
             rootfs_url=self._blueprint.rootfs['url'],
             rootfs_md5=self._blueprint.rootfs['md5'],
-            rootfs_sha1=self._blueprint.rootfs['sha1'])
+            rootfs_sha1=self._blueprint.rootfs['sha1'],
+            rootfs_sha256=self._blueprint.rootfs['sha256'])
+
+        # Host paths of the rootfs files written or read by the assembler
+        self._sysroot_path = self._root_obj.rootpath()
+        self._etc_version_path = self._root_obj.rootpath(
+                                            "etc", "OPX-release-version")
+        self._install_opx_path = self._root_obj.rootpath(
+                                            "root", "install_opx.sh")
+        self._passwd_path = self._root_obj.rootpath('etc', 'passwd')
+        self._archives_path = self._root_obj.rootpath('var', 'cache', 'apt',
+                                                      'archives')
 
         if verbosity >= 2:
-            pathname = self._root_obj.rootpath('etc', 'passwd')
+            pathname = self._passwd_path
             try:
                 with open(pathname, 'r') as pwd:
                     print("")
                     print("AFTER: %s:" % pathname)
-                    for line in pwd.readlines():
-                        print(line.strip())
+                    for line in pwd:
+                        print(line.rstrip('\n'))
                     print("")
             except:
                 print("WARNING: AFTER, Can't read %s" % pathname)
@@ -760,18 +877,12 @@ class OpxRelPackageAssembler(object):
     def get_version_info(self):
         """
         Determine the version based on Bamboo environment variables.
-        """
 
-        current_time = time.time()
-        try:
-            build_date = os.environ['bamboo_buildTimeStamp']
-        except KeyError:
-            build_date = time.strftime('%FT%T%z')
-
-        current_localtime = time.localtime(current_time)
-        current_year = current_localtime.tm_year
-        copyright_string = "Copyright (c) 1999-%4d by Dell EMC Inc. All Rights Reserved."  \
-                           % (current_year)
+        The version is computed once, so every output of the assembler
+        carries the same build date.
+        """
+        if self._version_info is not None:
+            return self._version_info
 
         version_info = {}
         version_info['name'] = self._blueprint.output_format['name']
@@ -782,9 +893,10 @@ class OpxRelPackageAssembler(object):
         version_info['architecture'] = self._blueprint.architecture
         version_info['bp_description'] = self._blueprint.description
         version_info['bp_version'] = self._blueprint.version
-        version_info['build_date'] = build_date
-        version_info['copyright'] = copyright_string
+        version_info['build_date'] = _BUILD_DATE
+        version_info['copyright'] = _COPYRIGHT
 
+        self._version_info = version_info
         return version_info
 
     def determine_version_info(self):
@@ -819,25 +931,26 @@ class OpxRelPackageAssembler(object):
         """
         Set environment variables used by onie-mk-opx.sh.
         """
+        messages = []
         for line in version_info:
-            (name, val) = re.split(r'=', line, maxsplit=1)
+            (name, val) = _EQ_SPLIT_RE.split(line, maxsplit=1)
             os.environ['INSTALLER_%s' % (name)] = val
-            sys.stderr.write("INFO: Set os.environ['INSTALLER_%s']=%s.\n"
+            messages.append("INFO: Set os.environ['INSTALLER_%s']=%s.\n"
                                                 % (name, val))
+        sys.stderr.writelines(messages)
 
     def write_etc_version_file(self, version_info):
         """
         Write /etc/OPX-release-version file.
         """
 
-        ar_v_filename = self._root_obj.rootpath("etc", "OPX-release-version")
+        ar_v_filename = self._etc_version_path
         try:
             with open(ar_v_filename, 'w') as ar_v_file:
-                for line in version_info:
-                    ar_v_file.write("%s\n" % (line))
+                ar_v_file.write("\n".join(version_info) + "\n")
                 os.fchmod(ar_v_file.fileno(), 0644)
-            subprocess.call(['/bin/ls', '-l', ar_v_filename])
-        except IOError, msg:
+            print(_ls_l(ar_v_filename))
+        except (IOError, OSError), msg:
             print("WARNING: Can't write '%s' : %s, in %s"
                     % (ar_v_filename, msg, os.getcwd()))
 
@@ -847,29 +960,22 @@ class OpxRelPackageAssembler(object):
         """
         print("write_installer_file(self)")
 
-        opx_install_file = self._root_obj.rootpath("root", "install_opx.sh")
+        opx_install_file = self._install_opx_path
 
-        # Create jinja2 environment, used for template expansion
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader(
-                        os.path.join(os.path.dirname(__file__), 'templates')))
-        template = env.get_template('install_opx_sh')
+        template = _JINJA_ENV.get_template('install_opx_sh')
 
         template_params = {}
-        template_params['package_sets'] = []
-        for pks in self._blueprint.package_sets:
-            pks_params = {}
-            pks_params['name'] = pks.name
-            pks_params['platform'] = pks.platform
-            pks_params['flavor'] = pks.flavor
-
-            packages = []
-            for pkg_list in pks.package_lists:
-                for pkg in pkg_list.packages:
-                    packages.append(pkg.name)
-
-            pks_params['packages'] = packages
-
-            template_params['package_sets'].append(pks_params)
+        template_params['package_sets'] = [
+            {
+                'name': pks.name,
+                'platform': pks.platform,
+                'flavor': pks.flavor,
+                'packages': [pkg.name
+                             for pkg_list in pks.package_lists
+                             for pkg in pkg_list.packages],
+            }
+            for pks in self._blueprint.package_sets
+        ]
 
         # Save version info into template
         template_params['release'] = self.get_version_info()
@@ -891,7 +997,7 @@ class OpxRelPackageAssembler(object):
         """
         print("filter_packages(self)")
 
-        rootfs_package_list = self._root_obj.installed_packages()
+        rootfs_package_list = frozenset(self._root_obj.installed_packages())
 
         for pks in self._blueprint.package_sets:
             for pkg_list in pks.package_lists:
@@ -900,6 +1006,32 @@ class OpxRelPackageAssembler(object):
                     if pkg_list.no_package_filter
                         or package.name not in rootfs_package_list]
 
+        # the package lists have changed
+        self._deb_lists = None
+        self._deb_names = None
+
+    def _blueprint_packages(self):
+        """
+        Return list of (package set, list of Debian package specifications
+        for the set) and the set of all package names in the blueprint,
+        traversing the package lists once
+        """
+        if self._deb_lists is None:
+            deb_lists = []
+            deb_names = set()
+            for pks in self._blueprint.package_sets:
+                deb_package_list = []
+                for pkg_list in pks.package_lists:
+                    for package in pkg_list.packages:
+                        deb_package_list.extend(package.toDebian())
+                        deb_names.add(package.name)
+                deb_lists.append((pks, deb_package_list))
+
+            self._deb_lists = deb_lists
+            self._deb_names = deb_names
+
+        return self._deb_lists, self._deb_names
+
     def update_rootfs(self):
         """
         update_rootfs() updates the package list from the upstream
@@ -909,9 +1041,7 @@ class OpxRelPackageAssembler(object):
         """
         print("update_rootfs(self)")
 
-        script_nm = os.path.join(os.path.dirname(__file__),
-                                 'templates', 'do_apt_upgrade_sh')
-        self._root_obj.do_chroot(script_nm)
+        self._root_obj.do_chroot(_APT_UPGRADE_SH)
 
 
     def add_packages(self):
@@ -921,12 +1051,7 @@ class OpxRelPackageAssembler(object):
         """
         print("add_packages(self)")
 
-        for pks in self._blueprint.package_sets:
-            deb_package_list = []
-            for pkg_list in pks.package_lists:
-                for package in pkg_list.packages:
-                    deb_package_list.extend(package.toDebian())
-
+        for pks, deb_package_list in self._blueprint_packages()[0]:
             if verbosity > 1:
                 print('Load %s of %s' % (pks.name, pks.kind))
 
@@ -942,18 +1067,33 @@ class OpxRelPackageAssembler(object):
 
             # fetch the packages from this package set
             with opx_get_packages.OpxPackages(
-                                    sysroot=self._root_obj.rootpath(),
+                                    sysroot=self._sysroot_path,
                                     pkg_sources=pks.package_sources,
                                     default_solver=pks.default_solver) \
                                 as packer:
                 packer.fetch(names=deb_package_list)
 
+        # the package cache has changed, list it again on next use
+        self._archive_debs = None
+
         # list all packages that have been fetched
         if verbosity > 2:
-            for mfn in self._root_obj.listdir(
-                    os.path.join("var", "cache", "apt", "archives")):
+            for mfn in self._list_archive_debs():
                 print(mfn)
 
+    def _list_archive_debs(self):
+        """
+        Return the names of the package archives in the rootfs package
+        cache.  The cache only changes in add_packages(), so the
+        directory is listed once and the result shared by the later
+        steps.
+        """
+        if self._archive_debs is None:
+            self._archive_debs = [fnm for fnm in
+                                  os.listdir(self._archives_path)
+                                  if fnm.endswith('.deb')]
+        return self._archive_debs
+
     def verify_packages(self):
         """
         verify_packages() checks that all the packages listed in the
@@ -961,12 +1101,8 @@ class OpxRelPackageAssembler(object):
         """
         print("verify_packages(self)")
 
-        # Populate the package list with the packages from the blueprint
-        deb_package_list = set()
-        for pks in self._blueprint.package_sets:
-            for pkg_list in pks.package_lists:
-                for package in pkg_list.packages:
-                    deb_package_list.add(package.name)
+        # The packages from the blueprint
+        deb_package_list = self._blueprint_packages()[1]
 
         if verbosity > 2:
             print("Expected package list: %s" % sorted(list(deb_package_list)))
@@ -974,10 +1110,8 @@ class OpxRelPackageAssembler(object):
         # Get the list of packages in the rootfs
         # This assumes that the packages are available in
         # /var/cache/apt/archives/
-        packages_path = self._root_obj.rootpath('var', 'cache', 'apt',
-                                            'archives')
-        rootfs_package_list = set(os.path.basename(pkg).split('_')[0] for pkg in
-            glob.glob(os.path.join(packages_path, '*.deb')))
+        rootfs_package_list = set(pkg.partition('_')[0]
+                                  for pkg in self._list_archive_debs())
 
         if verbosity > 2:
             print("Downloaded package list: %s"
@@ -998,9 +1132,7 @@ class OpxRelPackageAssembler(object):
         if verbosity > 1:
             print("Create the script")
 
-        script_nm = os.path.join(os.path.dirname(__file__),
-                                 'templates',
-                                 'do_dpkg_sh')
+        script_nm = _DPKG_SH
 
         # We don't install packages if we are creating
         #  the ONIE installer with package cache payload
@@ -1014,21 +1146,11 @@ class OpxRelPackageAssembler(object):
         '''
         Record artifact for Artifactory build-info metadata
         '''
-        with open(pathname, 'rb') as f:
-            # Compute hashes
-            h_md5 = hashlib.md5()
-            h_sha1 = hashlib.sha1()
-            buf = f.read(8192)
-            while len(buf) > 0:
-                h_md5.update(buf)
-                h_sha1.update(buf)
-                buf = f.read(8192)
-
-        artifact = {
-            'name': os.path.basename(pathname),
-            'md5': h_md5.hexdigest(),
-            'sha1': h_sha1.hexdigest(),
-        }
+        hashes = opx_rootfs.compute_file_hashes(pathname, _BUILD_INFO_HASHES)
+
+        artifact = {'name': os.path.basename(pathname)}
+        for algo, h in hashes.items():
+            artifact[algo] = h.hexdigest()
 
         if pathname.endswith('.bin'):
             artifact['type'] = 'bin'
@@ -1041,22 +1163,39 @@ class OpxRelPackageAssembler(object):
         '''
         Record dependency for Artifactory build-info metadata
         '''
+        self.dependencies.append(self._dependency_info(pathname))
+
+    def add_dependencies(self, pathnames):
+        '''
+        Record dependencies for Artifactory build-info metadata,
+        hashing the files concurrently
+        '''
+        # hashlib releases the GIL while hashing large buffers, so
+        # threads are enough to use several cores
+        pool = ThreadPool(multiprocessing.cpu_count())
+        try:
+            self.dependencies.extend(
+                pool.map(self._dependency_info, pathnames))
+        finally:
+            pool.close()
+            pool.join()
 
-        h_md5 = self._root_obj.compute_md5(pathname)
-        h_sha1 = self._root_obj.compute_sha1(pathname)
+    def _dependency_info(self, pathname):
+        '''
+        Return Artifactory build-info dependency record for pathname
+        '''
+        hashes = self._root_obj.compute_hashes(pathname, _BUILD_INFO_HASHES)
 
-        dependency = {
-            'id': os.path.basename(pathname),
-            'md5': h_md5.hexdigest(),
-            'sha1': h_sha1.hexdigest(),
-        }
+        dependency = {'id': os.path.basename(pathname)}
+        for algo, h in hashes.items():
+            dependency[algo] = h.hexdigest()
 
         if pathname.endswith('.deb'):
             dependency['type'] = 'deb'
         elif pathname.endswith(('.tgz', '.tar.gz')):
             dependency['type'] = 'tgz'
 
-        self.dependencies.append(dependency)
+        return dependency
 
     def copy_inst_hooks(self, dist):
         """
@@ -1077,42 +1216,46 @@ class OpxRelPackageAssembler(object):
                 raise
 
         for hook in self._blueprint.inst_hooks:
-            shutil.copy(hook.hook_file_path, destpath)
+            # Copy to an explicit file name, which lets copyfile()
+            # use its in-kernel fast path where one is available
+            new_hook = os.path.join(destpath, hook.hook_file)
+            shutil.copyfile(hook.hook_file_path, new_hook)
+            shutil.copymode(hook.hook_file_path, new_hook)
 
             # Change distribution in apt inst-hook
-            # TODO: Do this in python, not sed
-            if hook.hook_file == '98-set-apt-sources.postinst.sh':
-                new_hook = "{}/{}".format(destpath, hook.hook_file)
-                subprocess.check_call([
-                    "/bin/sed",
-                    "-i",
-                    "s#openswitch.net/jessie unstable#openswitch.net/jessie {}#g".format(dist),
-                    new_hook,
-                ])
-            if hook.hook_file == '98-set-apt-sources.stretch.postinst.sh':
-                new_hook = "{}/{}".format(destpath, hook.hook_file)
-                subprocess.check_call([
-                    "/bin/sed",
-                    "-i",
-                    "s#openswitch.net/stretch unstable#openswitch.net/stretch {}#g".format(dist),
-                    new_hook,
-                ])
-
-
-    def make_output(self):
+            repo = _APT_SOURCES_HOOKS.get(hook.hook_file)
+            if repo is not None:
+                with open(new_hook, 'r+') as fd_:
+                    data = fd_.read().replace(repo + ' unstable',
+                                              repo + ' ' + dist)
+                    fd_.seek(0)
+                    fd_.write(data)
+                    fd_.truncate()
+
+    def make_output(self, record_dependencies=True):
         """
         make_output() -- create requested output
             depends on the the plan, tests its request
             as True or False for package cache archive
             ONIE installer, or tar gzip archive of rootfs
+
+            record_dependencies -- if False, the package cache
+            archives are not hashed and recorded as dependencies,
+            for builds without build-info output
         """
 
         print("make_output(self)")
 
+        fmt = self._blueprint.output_format
+        is_onie_pkg = fmt['ONIE_pkg']
+        is_onie_image = fmt['ONIE_image']
+        is_pkg_cache = fmt['package_cache']
+        is_tar_archive = fmt['tar_archive']
+
         nm_prefix = '{}{}-{}{}{}'.format(
-            'PKGS_' if self._blueprint.output_format['ONIE_pkg'] else '',
-            self._blueprint.output_format['name'],
-            self._blueprint.output_format['version'],
+            'PKGS_' if is_onie_pkg else '',
+            fmt['name'],
+            fmt['version'],
             '.{}'.format(build_num) if build_num != 0 else '',
             build_suffix
         )
@@ -1127,16 +1270,18 @@ class OpxRelPackageAssembler(object):
 
         # need to make a list of dir entries that endwith .deb
         path = os.path.join('var', 'cache', 'apt', 'archives')
-        flist = [fnm for fnm in self._root_obj.listdir(path)
-                    if fnm.endswith('.deb')]
+        flist = self._list_archive_debs()
         if verbosity > 2:
             print(flist)
 
+        # rootfs relative pathnames of the archives, path is POSIX
+        full_paths = [path + '/' + f for f in flist]
+
         if flist:
-            for f in flist:
-                self.add_dependency(os.path.join(path, f))
+            if record_dependencies:
+                self.add_dependencies(full_paths)
 
-            if self._blueprint.output_format['package_cache']:
+            if is_pkg_cache:
                 if verbosity > 1:
                     print("INFO: creating %s\n" % pkgcache_path)
                     sys.stdout.flush()
@@ -1152,17 +1297,16 @@ class OpxRelPackageAssembler(object):
 
         # clean out the debian package cache before we
         #  build the other (possibly) requested items
-        if not self._blueprint.output_format['ONIE_pkg']:
+        if not is_onie_pkg:
             if verbosity > 1:
                 print("INFO: removing files from the package cache")
                 sys.stdout.flush()
 
-            for debfn in flist:
-                try:
-                    self._root_obj.remove(os.path.join(path, debfn))
-                except opx_rootfs.OpxrootfsError as ex:
-                    print("WARNING: for Opxrootfs.remove(%s), ignoring %s."
-                            % (path, ex))
+            try:
+                self._root_obj.remove_many(full_paths)
+            except opx_rootfs.OpxrootfsError as ex:
+                print("WARNING: for Opxrootfs.remove_many(%s), ignoring %s."
+                        % (path, ex))
         else:
             rootpath = self._root_obj.rootpath(path)
             opx_bld_basics.gen_package_list(rootpath)
@@ -1187,73 +1331,64 @@ class OpxRelPackageAssembler(object):
 
         # Clean out apt state
         # -- rootfs should not not reference our package sources.
-        for path in [
+        apt_state = [path for path in [
                 os.path.join('etc', 'apt', 'sources.list'),
                 os.path.join('etc', 'apt', 'sources.list.save'),
                 os.path.join('var', 'cache', 'apt', 'pkgcache.bin'),
-        ]:
-            if self._root_obj.exists(path):
-                if verbosity > 1:
-                    print("INFO: removing %s" % path)
-                    sys.stdout.flush()
-
-                try:
-                    self._root_obj.remove(path)
-                except opx_rootfs.OpxrootfsError as ex:
-                    print("WARNING: for Opxrootfs.remove(%s), ignoring %s."
-                            % (path, ex))
-
-        # Remove any artifacts left in the rootfs image /tmp directory
-        for fnm in self._root_obj.listdir('/tmp'):
-            path = os.path.join('/tmp', fnm)
+                os.path.join('var', 'cache', 'apt', 'srcpkgcache.bin'),
+                os.path.join('var', 'cache', 'apt', 'opx-lock.json'),
+                os.path.join('var', 'lib', 'apt', 'lists', 'opx-sources.list'),
+        ] if self._root_obj.exists(path)]
 
-            if verbosity > 1:
+        # Remove the apt state and any artifacts left in the rootfs
+        #  image /tmp directory, under one fakeroot
+        if verbosity > 1:
+            for path in apt_state:
                 print("INFO: removing %s" % path)
-                sys.stdout.flush()
+            for fnm in self._root_obj.listdir('/tmp'):
+                print("INFO: removing %s" % os.path.join('/tmp', fnm))
+            sys.stdout.flush()
 
-            if self._root_obj.isdir(path):
-                try:
-                    self._root_obj.rmtree(path)
-                except opx_rootfs.OpxrootfsError as ex:
-                    print("WARNING: for Opxrootfs.rmtree(%s), ignoring %s."
-                            % (path, ex))
-            else:
-                try:
-                    self._root_obj.remove(path)
-                except opx_rootfs.OpxrootfsError as ex:
-                    print("WARNING: for Opxrootfs.remove(%s), ignoring %s."
-                            % (path, ex))
+        try:
+            with self._root_obj.batch():
+                if apt_state:
+                    self._root_obj.remove_many(apt_state)
+                self._root_obj.reset_tmp()
+        except opx_rootfs.OpxrootfsError as ex:
+            print("WARNING: for Opxrootfs cleanup, ignoring %s." % (ex))
 
         # these output formats use a rootfs tar gzipped archive
         #  so build it here, package cache just pulls its contents
         #  out, but doesn't need to archive the root image
-        if (self._blueprint.output_format['ONIE_image']
-                or self._blueprint.output_format['ONIE_pkg']
-                or self._blueprint.output_format['tar_archive']):
+        if is_onie_image or is_onie_pkg or is_tar_archive:
             if verbosity > 1:
                 print("INFO: creating %s\n" % (rootfs_path))
                 sys.stdout.flush()
 
             try:
                 self._root_obj.tar_out(rootfs_path)
-            except opx_rootfs.OpxrootfsError as ex:
+            except opx_rootfs.OpxrootfsSymlinkLoopError as ex:
                 # Try to address the 'too many levels of symbolic links'
-                # errors, which seem to happen randomly.
+                # errors, which seem to happen randomly.  Other failures
+                # are not retried, they'd just fail again.
                 print("WARNING: First attempt to create tar file failed: %s"
                         % (ex))
+                subprocess.call(['sync'])
                 try:
                     self._root_obj.tar_out(rootfs_path)
                 except opx_rootfs.OpxrootfsError as ex:
                     print("ERROR: Second attempt to create tar file failed: %s"
                             % (ex))
                     raise
+            except opx_rootfs.OpxrootfsError as ex:
+                print("ERROR: tar file creation failed: %s" % (ex))
+                raise
 
         # to create the ONIE image, we use the current sysroot
         #  archive to create the ONIE installer, create what
         #  would be the output of the open-source-rootfs build
         #  and use ngos.sh to build the ONIE installer image
-        if (self._blueprint.output_format['ONIE_image']
-                or self._blueprint.output_format['ONIE_pkg']):
+        if is_onie_image or is_onie_pkg:
             if verbosity > 1:
                 print("creating %s\n" % (image_path))
                 sys.stdout.flush()
@@ -1274,7 +1409,7 @@ class OpxRelPackageAssembler(object):
 
             self.add_artifact(image_path)
 
-        if self._blueprint.output_format['tar_archive']:
+        if is_tar_archive:
             self.add_artifact(rootfs_path)
         else:
             # If blueprint was not set to generate rootfs tarball,
@@ -1284,7 +1419,7 @@ class OpxRelPackageAssembler(object):
 
 def index_local_packages(dist):
     """Run the idx-pkgs script from opx-build/scripts with the correct dist."""
-    cmd = '{}/idx-pkgs'.format(os.path.dirname(__file__))
+    cmd = _IDX_PKGS
     try:
         subprocess.check_call([cmd, dist])
     except subprocess.CalledProcessError as ex:
@@ -1357,7 +1492,7 @@ def main():
     rel_plan.verify_packages()
     rel_plan.install_packages()
     rel_plan.copy_inst_hooks(args.dist)
-    rel_plan.make_output()
+    rel_plan.make_output(record_dependencies=bool(args.build_info))
 
     end_timestamp = datetime.datetime.now()
     duration = end_timestamp - start_timestamp
@@ -1385,7 +1520,10 @@ def main():
                 },
             ],
             'properties': {
-                "buildInfo.env." + key: val for key, val in os.environ.items()
+                "buildInfo.env." + key: val
+                for key, val in os.environ.items()
+                if key in _BUILD_INFO_ENV
+                    or key.startswith(_BUILD_INFO_ENV_PREFIXES)
             },
         }
 
@@ -1396,8 +1534,9 @@ def main():
         if args.vcs_revision is not None:
             build_info['vcsRevision'] = args.vcs_revision
 
+        # Only read by Artifactory, so skip the pretty-printing
         with open(args.build_info, 'w') as f:
-            json.dump(build_info, f, indent=4)
+            json.dump(build_info, f, separators=(',', ':'))
 
     return 0
 
@@ -14,31 +14,145 @@ See the open-source-rootfs repository for details.
 """
 
 from __future__ import print_function
+import atexit
+import contextlib
+import errno
+import functools
 import hashlib
+import io
+import itertools
+import mmap
+import re
 import sys
 import os
 import stat
 import shutil
 import subprocess
 import requests
+import requests.adapters
 import requests_file
 import tempfile
+import threading
+from distutils.spawn import find_executable
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
 
 verbosity = 1
 
 FAKECHROOT = 'fakechroot'
 FAKEROOT = 'fakeroot'
 
+# Parallel gzip on the host, used for tar_in and tar_out archives
+PIGZ = find_executable('pigz')
+
+# strerror() text tar reports for a symbolic link loop (ELOOP)
+ELOOP_MESSAGE = os.strerror(errno.ELOOP)
+
+# Package name in an apt list --installed line, which has the form
+#  util-linux/stable,now 2.25.2-6 amd64 [installed]
+# The "Listing..." header doesn't match
+APT_LIST_PACKAGE_RE = re.compile(r'([^/\s]+)/')
+
+# Block size used when downloading and hashing the rootfs archive
+HASH_BLOCK_SIZE = 1 << 20
+
+# Number of blocks a HashThread may fall behind before blocking
+HASH_QUEUE_DEPTH = 8
+
+# Maximum number of paths passed to a single remove_many() command
+REMOVE_BATCH_SIZE = 4000
+
+
+def compute_file_hashes(pathname, algos=('md5', 'sha1')):
+    """
+    Compute several digests of file :param:`pathname` in a single pass.
+
+    The file is memory mapped, so each digest is computed by a single
+    :mod:`hashlib` call without copying the contents.  Files that can't
+    be mapped are read in :data:`HASH_BLOCK_SIZE` blocks into a single
+    reused buffer.
+
+    :param algos: names of :mod:`hashlib` algorithms
+    :returns: dict of algorithm name to hashlib object
+    """
+    hashes = [hashlib.new(algo) for algo in algos]
+
+    with io.open(pathname, 'rb') as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # empty, or not a regular file
+            buf = bytearray(HASH_BLOCK_SIZE)
+            view = memoryview(buf)
+            n = f.readinto(buf)
+            while n:
+                for h in hashes:
+                    h.update(view[:n])
+                n = f.readinto(buf)
+        else:
+            try:
+                for h in hashes:
+                    h.update(m)
+            finally:
+                m.close()
+
+    return dict(zip(algos, hashes))
+
+def _tar_env():
+    """
+    Returns the environment to run tar in, where xz uses all cores
+    unless XZ_OPT says otherwise.
+    """
+    env = dict(os.environ)
+    env.setdefault('XZ_OPT', '-T0')
+    return env
+
+class HashThread(threading.Thread):
+    """
+    Thread computing a digest of the blocks put on its :attr:`queue`,
+    until None is put.
+
+    :mod:`hashlib` releases the GIL while hashing large blocks, so
+    several digests of a stream can be computed in parallel.
+    """
+    def __init__(self, algo):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.hash = hashlib.new(algo)
+        self.queue = queue.Queue(HASH_QUEUE_DEPTH)
+
+    def run(self):
+        for block in iter(self.queue.get, None):
+            self.hash.update(block)
+
+# TemporaryDirectory instances not yet cleaned up, removed at exit
+_live_tempdirs = set()
+
+@atexit.register
+def _cleanup_tempdirs():
+    for tmpdir in list(_live_tempdirs):
+        tmpdir.cleanup()
+
 class TemporaryDirectory(object):
     """
     Context Manager for managing lifetime of a temporary directory
 
     This was inspired by Python 3's tempfile.TemporaryDirectory
-    class.
+    class.  Any directory not cleaned up before is removed at exit,
+    rather than when garbage collected.
     """
     def __init__(self, suffix="", prefix="tmp", dir=None):
         self.closed = False
         self.name = tempfile.mkdtemp(suffix, prefix, dir)
+        _live_tempdirs.add(self)
 
     def __enter__(self):
         return self.name
@@ -46,20 +160,23 @@ class TemporaryDirectory(object):
     def __exit__(self, *args):
         self.cleanup()
 
-    def __del__(self):
-        self.cleanup()
-
     def cleanup(self):
+        # rm walks a large rootfs tree much faster than shutil.rmtree
         if not self.closed:
             try:
-                shutil.rmtree(self.name)
+                subprocess.call(['rm', '-rf', '--', self.name])
             except:
                 pass
             self.closed = True
+            _live_tempdirs.discard(self)
 
 class OpxrootfsError(Exception):
     pass
 
+class OpxrootfsSymlinkLoopError(OpxrootfsError):
+    """tar_out() failed reporting a symbolic link loop"""
+    pass
+
 class Opxrootfs(object):
     """
     OPX root file system class
@@ -88,7 +205,8 @@ class Opxrootfs(object):
         elif verbosity > 0:
             print(path + " already exists", file=sys.stderr)
 
-    def __init__(self, rootfs_path, rootfs_url, rootfs_sha1=None, rootfs_md5=None):
+    def __init__(self, rootfs_path, rootfs_url, rootfs_sha1=None, rootfs_md5=None,
+                 rootfs_sha256=None):
         """
         Initialize the rootfs instance
         Creates a root file system in the specified directory,
@@ -99,13 +217,24 @@ class Opxrootfs(object):
         :param:`rootfs_url`
            url to initial rootfs location
         :param:`rootfs_sha1`
-           SHA1 digest of rootfs tarball
+           SHA1 digest of rootfs tarball, checked instead of
+           the MD5 digest when given
         :param:`rootfs_md5`
            MD5 digest of rootfs tarball
+        :param:`rootfs_sha256`
+           SHA-256 digest of rootfs tarball, checked instead of
+           the MD5 and SHA1 digests when given
         """
 
-        # Create temporary file for fakeroot state
+        # Create temporary file for fakeroot state, and the fakeroot
+        #  command prefix using it
         self._fakeroot_state = tempfile.NamedTemporaryFile()
+        self._fakeroot_cmd = [FAKEROOT,
+                              '-i', self._fakeroot_state.name,
+                              '-s', self._fakeroot_state.name]
+
+        # fakeroot shell run by batch(), when one is active
+        self._batch = None
 
         # Create temporary directory for rootfs
         # if rootfs_path is None, use a temporary directory;
@@ -118,58 +247,102 @@ class Opxrootfs(object):
             shutil.rmtree(self._rootpath, ignore_errors=True)
             self._my_mkdir(self._rootpath)
 
-        # Use temporary file to hold incoming rootfs tar
-        with tempfile.NamedTemporaryFile() as fd_:
-            # request the specified archive
-            print("fetching %s ..." % rootfs_url)
-
-            s = requests.Session()
-            s.mount('file://', requests_file.FileAdapter())
-
-            resp = s.get(rootfs_url, stream=True)
-            if not resp.status_code == requests.codes.ok:
-                print(".remote fetch failed for %s : %d."
-                      % (rootfs_url, resp.status_code),
-                      file=sys.stderr)
-                print(resp.headers['status'], file=sys.stderr)
-                resp.raise_for_status()
-
-            chunk_size = 4096
-            md5 = hashlib.md5()
-            sha1 = hashlib.sha1()
-            for chunk in resp.iter_content(chunk_size):
-                md5.update(chunk)
-                sha1.update(chunk)
-                fd_.write(chunk)
-            fd_.flush()
-
-            # Validate MD5 digest
-            if rootfs_md5:
-                if rootfs_md5 != md5.hexdigest():
-                    raise OpxrootfsError("MD5 validation failed: got %s, expected %s"
-                        % (md5.hexdigest(), rootfs_md5))
-
-            # Validate SHA1 digest
-            if rootfs_sha1:
-                if rootfs_sha1 != sha1.hexdigest():
-                    raise OpxrootfsError("SHA1 validation failed: got %s, expected %s"
-                        % (sha1.hexdigest(), rootfs_sha1))
-
-            # load the initial file system
-            self.tar_in(fd_.name)
+        # request the specified archive
+        print("fetching %s ..." % rootfs_url)
+
+        # a single archive is fetched, so one pooled connection will do
+        s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=1)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        s.mount('file://', requests_file.FileAdapter())
+
+        resp = s.get(rootfs_url, stream=True)
+        if not resp.status_code == requests.codes.ok:
+            print(".remote fetch failed for %s : %d."
+                  % (rootfs_url, resp.status_code),
+                  file=sys.stderr)
+            print(resp.headers['status'], file=sys.stderr)
+            resp.raise_for_status()
+
+        # read the raw stream directly, rather than through the
+        #  iter_content() generator; still undoing any content encoding
+        resp.raw.decode_content = True
+        read = functools.partial(resp.raw.read, HASH_BLOCK_SIZE)
+
+        # load the initial file system, extracting the archive as it
+        #  is downloaded; the digests are computed in parallel, and the
+        #  compression is told from the first block
+        head = read()
+        cmd = self._tar_in_cmd('/', self._decompress_args(head))
+        if verbosity > 0:
+            print("tar_in(%s)" % cmd)
+
+        # only the strongest digest given is computed and checked
+        if rootfs_sha256:
+            digests = [('sha256', rootfs_sha256)]
+        elif rootfs_sha1:
+            digests = [('sha1', rootfs_sha1)]
+        elif rootfs_md5:
+            digests = [('md5', rootfs_md5)]
+        else:
+            digests = []
+
+        hashers = [HashThread(algo) for algo, _ in digests]
+        for hasher in hashers:
+            hasher.start()
+
+        # unbuffered, so closing stdin can't fail flushing to a dead tar
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, bufsize=0,
+                                env=_tar_env())
+        writing = True
+        try:
+            for chunk in itertools.chain([head], iter(read, b'')):
+                for hasher in hashers:
+                    hasher.queue.put(chunk)
+                if not writing:
+                    continue
+                try:
+                    proc.stdin.write(chunk)
+                except EnvironmentError as ex:
+                    # tar exited early, its exit status is reported
+                    #  below; keep hashing the rest of the download so
+                    #  the digest is always checked
+                    if ex.errno != errno.EPIPE:
+                        raise
+                    writing = False
+        finally:
+            for hasher in hashers:
+                hasher.queue.put(None)
+                hasher.join()
+            proc.stdin.close()
+            ret = proc.wait()
+
+        try:
+            # Validate digests
+            for (algo, expected), hasher in zip(digests, hashers):
+                digest = hasher.hash.hexdigest()
+                if expected != digest:
+                    raise OpxrootfsError("%s validation failed: got %s, expected %s"
+                        % (algo.upper(), digest, expected))
+
+            if ret:
+                if verbosity > 0:
+                    print(subprocess.CalledProcessError(ret, cmd))
+                raise OpxrootfsError("Can't extract tarball")
+        except OpxrootfsError:
+            # don't leave a partial or unverified rootfs behind
+            shutil.rmtree(self._rootpath, ignore_errors=True)
+            raise
 
     def rootpath(self, *args):
         """
         Return host path to the rootfs path :param:`path`.
         """
 
-        path = self._rootpath
-        for x in args:
-            if not path.endswith('/') and not x.startswith('/'):
-                path += '/'
-            path += x
-
-        return path
+        # rootfs paths may be absolute, but are always under the root
+        return os.path.join(self._rootpath, *[x.lstrip('/') for x in args])
 
     def exists(self, path):
         """
@@ -215,41 +388,85 @@ class Opxrootfs(object):
         """
         return os.listdir(self.rootpath(path))
 
-    def compute_md5(self, path):
+    def compute_hashes(self, path, algos=('md5', 'sha1')):
         """
-        Returns hashlib.md5 object of file given path path.
+        Returns dict of algorithm name to hashlib object of file given
+        path path, reading the file once for all of algos.
 
 
         .. note::
            since this only accesses file contents, we should not
            have to do this under fakeroot.
         """
-        with open(self.rootpath(path), 'rb') as f:
-            md5 = hashlib.md5()
-            buf = f.read(8192)
-            while len(buf) > 0:
-                md5.update(buf)
-                buf = f.read(8192)
+        return compute_file_hashes(self.rootpath(path), algos)
 
-        return md5
+    def compute_md5(self, path):
+        """
+        Returns hashlib.md5 object of file given path path.
+        """
+        return self.compute_hashes(path, ('md5',))['md5']
 
     def compute_sha1(self, path):
         """
         Returns hashlib.sha1 object of file given path path.
+        """
+        return self.compute_hashes(path, ('sha1',))['sha1']
 
+    def _fakeroot_call(self, args, failure):
+        """
+        Run command :param:`args` under fakeroot, raising
+        :class:`OpxrootfsError` with message :param:`failure`
+        if it fails.
 
-        .. note::
-           since this only accesses file contents, we should not
-           have to do this under fakeroot.
+        Within :meth:`batch`, the command is queued to the batch
+        shell instead, and its failure reported when the batch ends.
         """
-        with open(self.rootpath(path), 'rb') as f:
-            sha1 = hashlib.sha1()
-            buf = f.read(8192)
-            while len(buf) > 0:
-                sha1.update(buf)
-                buf = f.read(8192)
+        if self._batch is not None:
+            self._batch.stdin.write(
+                "%s || { echo %s >&2; status=1; }\n"
+                % (' '.join(quote(arg) for arg in args), quote(failure)))
+            return
 
-        return sha1
+        cmd = self._fakeroot_cmd + args
+
+        try:
+            subprocess.check_call(cmd)
+        except subprocess.CalledProcessError as ex:
+            if verbosity > 0:
+                print(ex)
+            raise OpxrootfsError(failure)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Run the :meth:`remove`, :meth:`remove_many`, :meth:`rename`,
+        :meth:`rmtree` and :meth:`reset_tmp` calls made in the ``with``
+        block under a single fakeroot shell, rather than starting
+        fakeroot, and loading its state, for each of them.
+
+        The calls don't raise errors, :class:`OpxrootfsError` is raised
+        at the end of the block if any of them failed.  The commands
+        are run in order, and all are complete when the block ends.
+        """
+        if self._batch is not None:
+            # nested, the outer batch runs the commands
+            yield
+            return
+
+        cmd = self._fakeroot_cmd + ['sh']
+        self._batch = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                       universal_newlines=True)
+        self._batch.stdin.write("status=0\n")
+        try:
+            yield
+        finally:
+            proc, self._batch = self._batch, None
+            proc.stdin.write("exit $status\n")
+            proc.stdin.close()
+            ret = proc.wait()
+
+        if ret:
+            raise OpxrootfsError("Can't complete fakeroot batch")
 
     def remove(self, path):
         """
@@ -258,38 +475,49 @@ class Opxrootfs(object):
         .. note::
            Run under fakeroot to keep database coherent.
         """
-        cmd = [FAKEROOT,
-               '-i', self._fakeroot_state.name,
-               '-s', self._fakeroot_state.name,
-               'rm', '-f', self.rootpath(path)
-        ]
+        self._fakeroot_call(['rm', '-f', self.rootpath(path)],
+                            "Can't remove(%s)" % path)
 
-        try:
-            subprocess.check_call(cmd)
-        except subprocess.CalledProcessError as ex:
-            if verbosity > 0:
-                print(ex)
-            raise OpxrootfsError("Can't remove(%s)" % path)
+    def remove_many(self, paths):
+        """
+        Removes files or directories :param:`paths`, using one
+        command per :data:`REMOVE_BATCH_SIZE` paths.
+
+        .. note::
+           Run under fakeroot to keep database coherent.
+        """
+        paths = list(paths)
+        for i in range(0, len(paths), REMOVE_BATCH_SIZE):
+            batch = paths[i:i + REMOVE_BATCH_SIZE]
+            args = ['rm', '-f', '--']
+            args.extend(self.rootpath(path) for path in batch)
+
+            self._fakeroot_call(args, "Can't remove_many(%s)" % batch)
 
     def rename(self, src, dst):
         """
         Rename file or directory :param:`src` to :param:`dst`.
 
         .. note::
-           Run under fakeroot to keep database coherent.
+           Run under fakeroot to keep database coherent, unless
+           :param:`dst` does not exist and a rename will do.
         """
-        cmd = [FAKEROOT,
-               '-i', self._fakeroot_state.name,
-               '-s', self._fakeroot_state.name,
-               'mv', '-f', self.rootpath(src), self.rootpath(dst)
-        ]
+        src_path = self.rootpath(src)
+        dst_path = self.rootpath(dst)
 
-        try:
-            subprocess.check_call(cmd)
-        except subprocess.CalledProcessError as ex:
-            if verbosity > 0:
-                print(ex)
-            raise OpxrootfsError("Can't rename(%s,%s)" % (src, dst))
+        # A rename keeps the inode, so fakeroot's ownership records
+        #  stay valid; fakeroot still has to see any file replaced,
+        #  and the commands queued by a batch have to run first
+        if self._batch is None and not os.path.lexists(dst_path):
+            try:
+                os.rename(src_path, dst_path)
+                return
+            except OSError:
+                # e.g. across file systems; mv reports real errors
+                pass
+
+        self._fakeroot_call(['mv', '-f', src_path, dst_path],
+                            "Can't rename(%s,%s)" % (src, dst))
 
     def rmtree(self, path):
         """
@@ -298,18 +526,20 @@ class Opxrootfs(object):
         .. note::
            Run under fakeroot to keep database coherent.
         """
-        cmd = [FAKEROOT,
-               '-i', self._fakeroot_state.name,
-               '-s', self._fakeroot_state.name,
-               'rm', '-rf', self.rootpath(path)
-        ]
+        self._fakeroot_call(['rm', '-rf', self.rootpath(path)],
+                            "Can't rmtree(%s)" % path)
 
-        try:
-            subprocess.check_call(cmd)
-        except subprocess.CalledProcessError as ex:
-            if verbosity > 0:
-                print(ex)
-            raise OpxrootfsError("Can't rmtree(%s)" % path)
+    def reset_tmp(self):
+        """
+        Remove the contents of the rootfs /tmp directory, keeping
+        the directory itself, in a single command.
+
+        .. note::
+           Run under fakeroot to keep database coherent.
+        """
+        self._fakeroot_call(['find', self.rootpath('tmp'), '-mindepth', '1',
+                             '-delete'],
+                            "Can't reset_tmp()")
 
     def do_chroot(self, op_path):
         """
@@ -322,18 +552,17 @@ class Opxrootfs(object):
         #  referenced by the path
         # copy the file, and insure execute permission
         _target = os.path.join(self._rootpath, os.path.basename(op_path))
-        shutil.copyfile(op_path, _target)
-        os.chmod(_target, (stat.S_IXUSR | stat.S_IRUSR
-                            | stat.S_IXGRP | stat.S_IRGRP
-                            | stat.S_IXOTH | stat.S_IROTH))
+        with open(op_path, 'rb') as src, open(_target, 'wb') as dst:
+            shutil.copyfileobj(src, dst, HASH_BLOCK_SIZE)
+            os.fchmod(dst.fileno(), (stat.S_IXUSR | stat.S_IRUSR
+                                     | stat.S_IXGRP | stat.S_IRGRP
+                                     | stat.S_IXOTH | stat.S_IROTH))
 
         # build up the fakeroot/fakechroot wrapper for the command
         #  assumes the command is in the root directory, and
         #  thus executes it there.
         cmd = [FAKECHROOT]
-        cmd += [FAKEROOT,
-                '-i', self._fakeroot_state.name,
-                '-s', self._fakeroot_state.name]
+        cmd += self._fakeroot_cmd
         cmd += ['/usr/sbin/chroot', self._rootpath]
         cmd += [os.path.sep + os.path.basename(op_path)]
 
@@ -367,18 +596,18 @@ class Opxrootfs(object):
             print("installed_packages")
             print(cmd)
 
-        package_list = []
-        # execute the command in the fakechroot environment and get the output
-        try:
-            for pkg_full in subprocess.check_output(cmd).split('\n'):
-                # An installed package has the form
-                # util-linux/stable,now 2.25.2-6 amd64 [installed]
-                # We only care about the package name (before the /)
-                pkg = pkg_full.split('/')[0]
-                package_list.append(pkg)
-        except subprocess.CalledProcessError as ex:
+        # execute the command in the fakechroot environment and read
+        #  the output as it's produced
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                universal_newlines=True)
+        matches = (APT_LIST_PACKAGE_RE.match(line) for line in proc.stdout)
+        package_list = [m.group(1) for m in matches if m]
+        proc.stdout.close()
+
+        ret = proc.wait()
+        if ret:
             if verbosity > 0:
-                print(ex)
+                print(subprocess.CalledProcessError(ret, cmd))
             raise OpxrootfsError("Error running apt list")
 
         # Return the installed package list to the caller
@@ -389,37 +618,72 @@ class Opxrootfs(object):
         Extract a compressed tar archive to the rootfs
 
         Extracts a tar archive from local file :param:`tarfile` into
-        rootfs directory :param:`directory`.
+        rootfs directory :param:`directory`.  If :param:`compress`, the
+        archive may be gzip, xz or bzip2 compressed, or not at all.
         """
         if verbosity > 0:
             print("tar_in(self, %s, %s)" % (tarfile, directory))
 
-        tar_cmd = ['tar', '-C', self.rootpath(directory), '-x', '-f', '-']
+        # unbuffered, so the seek back also moves the offset tar reads at
+        with open(tarfile, 'rb', 0) as fd_:
+            if compress:
+                decompress_args = self._decompress_args(fd_.read(6))
+                fd_.seek(0)
+            else:
+                decompress_args = []
+            cmd = self._tar_in_cmd(directory, decompress_args)
 
-        if compress:
-            tar_cmd += ['-z']
-
-        if verbosity > 1:
-            tar_cmd += ['-v']
-
-        tar_cmd += ['--numeric-owner', '--preserve-permissions']
-
-        with open(tarfile, 'r') as fd_:
-            cmd = [FAKEROOT,
-                    '-i', self._fakeroot_state.name,
-                    '-s', self._fakeroot_state.name]
-            cmd += tar_cmd
+            # tar reads the archive once, start to end
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(fd_.fileno(), 0, 0,
+                                 os.POSIX_FADV_SEQUENTIAL)
 
             if verbosity > 0:
                 print("tar_in(%s)" % cmd)
 
             try:
-                subprocess.check_call(cmd, stdin=fd_)
+                subprocess.check_call(cmd, stdin=fd_, env=_tar_env())
             except subprocess.CalledProcessError as ex:
                 if verbosity > 0:
                     print(ex)
                 raise OpxrootfsError("Can't extract tarball")
 
+    @staticmethod
+    def _decompress_args(head):
+        """
+        Returns the tar options decompressing an archive starting
+        with bytes :param:`head`.
+
+        tar can't tell the compression of an archive read from a pipe.
+        """
+        # tar runs on the host here, so it can use pigz directly; tar
+        #  adds the -d when decompressing
+        if head.startswith(b'\x1f\x8b'):
+            if PIGZ:
+                return ['--use-compress-program=' + PIGZ]
+            return ['-z']
+        if head.startswith(b'\xfd7zXZ\x00'):
+            return ['-J']
+        if head.startswith(b'BZh'):
+            return ['-j']
+        return []
+
+    def _tar_in_cmd(self, directory, decompress_args):
+        """
+        Returns the command extracting a tar archive read from stdin
+        into rootfs directory :param:`directory`, decompressing it
+        with tar options :param:`decompress_args`.
+        """
+        tar_cmd = ['tar', '-C', self.rootpath(directory), '-x', '-f', '-']
+        tar_cmd += decompress_args
+
+        if verbosity > 1:
+            tar_cmd += ['-v']
+
+        tar_cmd += ['--numeric-owner', '--preserve-permissions']
+
+        return self._fakeroot_cmd + tar_cmd
+
     def tar_out(self, tarfile, directory='/', compress=True, files=['.']):
         """
         Create a compressed tar archive from the rootfs
@@ -432,8 +696,14 @@ class Opxrootfs(object):
 
         tar_cmd = ['tar', '-C', directory, '-c', '-f', '-']
 
+        # Compress with the host's pigz where available, which uses all
+        #  cores, rather than the single threaded gzip in the rootfs
+        zcmd = None
         if compress:
-            tar_cmd += ['-z']
+            if PIGZ:
+                zcmd = [PIGZ, '-c']
+            else:
+                tar_cmd += ['-z']
 
         if verbosity > 1:
             tar_cmd += ['-v']
@@ -442,9 +712,7 @@ class Opxrootfs(object):
 
         with open(tarfile, 'w') as fd_:
             cmd = [FAKECHROOT, '-e', 'none']
-            cmd += [FAKEROOT,
-                    '-i', self._fakeroot_state.name,
-                    '-s', self._fakeroot_state.name]
+            cmd += self._fakeroot_cmd
             cmd += ['/usr/sbin/chroot', self._rootpath]
             cmd += tar_cmd
 
@@ -452,12 +720,62 @@ class Opxrootfs(object):
                 print("tar_out(%s)" % cmd)
 
             try:
-                subprocess.check_call(cmd, stdout=fd_)
+                self._pipe_to(cmd, zcmd, fd_)
             except subprocess.CalledProcessError as ex:
                 if verbosity > 0:
                     print(ex)
+                if ex.output and ELOOP_MESSAGE in ex.output:
+                    raise OpxrootfsSymlinkLoopError(
+                            "Can't create tarball: %s" % ex.output.strip())
                 raise OpxrootfsError("Can't create tarball")
 
+    @staticmethod
+    def _pipe_to(cmd, filter_cmd, fd_):
+        """
+        Run :param:`cmd` with its output written to file :param:`fd_`,
+        piped through :param:`filter_cmd` unless that is None.
+
+        The standard error of :param:`cmd` is passed through.  Raises
+        :class:`subprocess.CalledProcessError` if either fails, with
+        the :attr:`output` of a :param:`cmd` failure set to its first
+        error line reporting a symbolic link loop, if any.
+        """
+        if filter_cmd is None:
+            proc = subprocess.Popen(cmd, stdout=fd_, stderr=subprocess.PIPE,
+                                    universal_newlines=True)
+            fproc = None
+        else:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    universal_newlines=True)
+            try:
+                fproc = subprocess.Popen(filter_cmd, stdin=proc.stdout,
+                                         stdout=fd_)
+            except OSError:
+                proc.kill()
+                proc.wait()
+                raise
+            finally:
+                # only the filter reads the pipe now, so cmd gets SIGPIPE
+                #  if the filter exits early
+                proc.stdout.close()
+
+        eloop = None
+        for line in iter(proc.stderr.readline, ''):
+            sys.stderr.write(line)
+            if eloop is None and ELOOP_MESSAGE in line:
+                eloop = line
+        proc.stderr.close()
+
+        fret = fproc.wait() if fproc is not None else 0
+        ret = proc.wait()
+
+        # report the filter first, it's why cmd dies when it fails
+        if fret:
+            raise subprocess.CalledProcessError(fret, filter_cmd)
+        if ret:
+            raise subprocess.CalledProcessError(ret, cmd, output=eloop)
+
 # Local Variables:
 # tab-width:4
 # indent-tabs-mode:nil